@@ -0,0 +1,274 @@
+""" batched augmentations in tensor space
+
+author seungwook
+"""
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+from dataset import transform_generator
+
+# transformations that move pixels around, they come first in every combination
+GEOMETRIC_TFS = ('crop', 'hflip', 'vflip', 'rotate')
+# transformations that map each pixel value through a 256 entry table
+LUT_TFS = ('invert', 'solarize')
+# transformations that are affine maps of the colour of a pixel, up to the hue shift
+COLOR_TFS = ('grayscale', 'colorjitter')
+
+# ITU-R 601-2 luma weights, same as PIL's convert('L')
+GRAY_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+def _rgb2hsv(x):
+    r, g, b = x.unbind(1)
+    maxc = torch.max(x, dim=1)[0]
+    minc = torch.min(x, dim=1)[0]
+    eqc = maxc == minc
+
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+
+    return torch.stack((h, s, maxc), dim=1)
+
+def _hsv2rgb(x):
+    h, s, v = x.unbind(1)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(dtype=torch.int32) % 6
+
+    p = (v * (1.0 - s)).clamp_(0, 1)
+    q = (v * (1.0 - s * f)).clamp_(0, 1)
+    t = (v * (1.0 - s * (1.0 - f))).clamp_(0, 1)
+
+    mask = i.unsqueeze(1) == torch.arange(6, device=i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=1)
+    a2 = torch.stack((t, v, v, q, p, p), dim=1)
+    a3 = torch.stack((p, p, t, v, v, q), dim=1)
+    a4 = torch.stack((a1, a2, a3), dim=1)
+
+    return torch.einsum('nijk,nxijk->nxjk', mask.to(dtype=x.dtype), a4)
+
+
+def collate_raw(batch):
+    """ collate_fn for a DataLoader over an AugmentedDataset in raw mode that leaves the images as they are """
+    if isinstance(batch, tuple):
+        # already batched by AugmentedDataset.__getitems__
+        return batch
+    return tuple(default_collate(batch))
+
+
+class BatchAugment(object):
+    """
+        Applies the tf combination of each aug label to a whole batch at once,
+        in uint8 with the random parameters of utils.get_all_tf_combs drawn
+        from dataset.transform_generator.
+    Args:
+        tf_combs: utils.TfCombinationSpace giving the tfs of every aug label
+        normalize: normalize the batch with the mean and std of tf_combs, or
+            return it uint8 to be normalized later (see utils.NormalizedLoader)
+    """
+    def __init__(self, tf_combs, normalize=True):
+        self.tfs = list(tf_combs.tfs)
+        # bit i of the mask of an aug label is set if it applies self.tfs[i]
+        self.masks = torch.as_tensor(tf_combs.masks, dtype=torch.int64)
+        self.mean = torch.tensor(tf_combs.mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(tf_combs.std).view(1, 3, 1, 1)
+        self.normalize = normalize
+
+        # invert commutes with blur (its kernel sums to 1), so the blur can run before the lut
+        self.stages = [
+            (self.bits(GEOMETRIC_TFS), self.geometric),
+            (self.bits(('blur',)), self.blur),
+            (self.bits(LUT_TFS), self.lut),
+            (self.bits(COLOR_TFS), self.color)
+        ]
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __call__(self, images, aug_labels):
+        """
+        Args:
+            images: uint8 tensor of shape [N, 3, H, W]
+            aug_labels: tensor of shape [N] indexing the tf combinations
+        Returns: normalized float tensor of shape [N, 3, H, W], or uint8 without normalize
+        """
+        x = images.clone(memory_format=torch.contiguous_format)
+        masks = self.masks.to(aug_labels.device)[aug_labels]
+
+        if len(aug_labels) > 1 and bool((aug_labels[1:] >= aug_labels[:-1]).all()):
+            labels, counts = torch.unique_consecutive(aug_labels, return_counts=True)
+            start = 0
+            for label, count in zip(labels.tolist(), counts.tolist()):
+                mask, end = int(self.masks[label]), start + count
+                for bits, stage in self.stages:
+                    if mask & bits:
+                        x[start:end] = stage(x[start:end], masks[start:end])
+                start = end
+        else:
+            for bits, stage in self.stages:
+                idx = (masks & bits).nonzero().squeeze(1)
+                if len(idx) > 0:
+                    x.index_copy_(0, idx, stage(x.index_select(0, idx), masks[idx]))
+
+        if not self.normalize:
+            return x
+
+        x = x.float().div_(255)
+        return (x - self.mean.to(x.device)) / self.std.to(x.device)
+
+    def collate(self, batch):
+        """ collate_fn for a DataLoader over an AugmentedDataset in raw mode """
+        images, true_labels, aug_labels = collate_raw(batch)
+        return self(images, aug_labels), true_labels, aug_labels
+
+    def bits(self, tfs):
+        """ the mask bits of the tfs """
+        return sum(1 << i for i, t in enumerate(self.tfs) if t in tfs)
+
+    def applies(self, masks, t):
+        """ whether each of the masks applies the tf t """
+        if t not in self.tfs:
+            return torch.zeros_like(masks, dtype=torch.bool)
+        return (masks >> self.tfs.index(t) & 1).bool()
+
+    # stages below take and return uint8 tensors of shape [n, 3, H, W] along with the masks of the samples
+
+    def geometric(self, x, masks, padding=4, degrees=90):
+        """ RandomCrop(32, padding=4), RandomHorizontalFlip(p=1.0), RandomVerticalFlip(p=1.0)
+        and RandomRotation(90) as applied by each mask, fused into one map from output
+        to input pixels. All of them use nearest interpolation, so the image is sampled
+        with a single integer gather that matches applying them one after the other.
+        """
+        n, c, h, w = x.shape
+        crop, hflip, vflip, rotate = [self.applies(masks, t).view(n, 1, 1) for t in GEOMETRIC_TFS]
+
+        generator = transform_generator(x.device)
+
+        # undo the counter-clockwise rotation around the center, as grid_sample would
+        angle = torch.empty(n, 1, 1, device=x.device).uniform_(-degrees, degrees, generator=generator).deg2rad_() * rotate
+        cos, sin = angle.cos(), angle.sin()
+        ys = (torch.arange(h, device=x.device) - (h - 1) / 2).view(1, h, 1)
+        xs = (torch.arange(w, device=x.device) - (w - 1) / 2).view(1, 1, w)
+        rows = torch.round(sin * xs + cos * ys + (h - 1) / 2)
+        cols = torch.round(cos * xs - sin * ys + (w - 1) / 2)
+        valid = (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+
+        # undo the flips
+        rows = torch.where(vflip, h - 1 - rows, rows)
+        cols = torch.where(hflip, w - 1 - cols, cols)
+
+        # undo the crop out of the zero padded image
+        i = torch.randint(0, 2 * padding + 1, (n, 1, 1), device=x.device, generator=generator) - padding
+        j = torch.randint(0, 2 * padding + 1, (n, 1, 1), device=x.device, generator=generator) - padding
+        rows = rows + i * crop
+        cols = cols + j * crop
+        valid &= (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+
+        src = (rows.clamp(0, h - 1) * w + cols.clamp(0, w - 1)).long().view(n, 1, h * w)
+        out = x.flatten(2).gather(2, src.expand(n, c, h * w)).view(n, c, h, w)
+
+        return out.masked_fill_(~valid.unsqueeze(1), 0)
+
+    def blur(self, x, masks, sigma=(0.1, 2.0)):
+        """ GaussianBlur(3, sigma=(0.1, 2.0)) with a separate sigma per sample """
+        n, c, h, w = x.shape
+        s = torch.empty(n, 1, device=x.device).uniform_(*sigma, generator=transform_generator(x.device))
+        kernel1d = torch.exp(-0.5 * (torch.arange(-1.0, 2.0, device=x.device) / s) ** 2)
+        kernel1d = kernel1d / kernel1d.sum(1, keepdim=True)
+        kernel2d = kernel1d.unsqueeze(2) * kernel1d.unsqueeze(1)
+        weight = kernel2d.repeat_interleave(c, dim=0).unsqueeze(1)
+
+        padded = F.pad(x.float(), (1, 1, 1, 1), mode='reflect').view(1, n * c, h + 2, w + 2)
+        out = F.conv2d(padded, weight, groups=n * c).view(n, c, h, w)
+
+        return out.round_().clamp_(0, 255).to(torch.uint8)
+
+    def lut(self, x, masks, threshold=128):
+        """ RandomInvert(p=1.0) and Solarization(1.0), i.e. ImageOps.solarize, as applied
+        by each mask, composed into one 256 entry table per sample """
+        n = x.shape[0]
+        table = torch.arange(256, device=x.device).expand(n, 256)
+        for t in self.tfs:
+            if t == 'invert':
+                table = torch.where(self.applies(masks, t).view(n, 1), 255 - table, table)
+            elif t == 'solarize':
+                table = torch.where(self.applies(masks, t).view(n, 1) & (table >= threshold), 255 - table, table)
+
+        return table.to(torch.uint8).gather(1, x.view(n, -1).long()).view_as(x)
+
+    def color(self, x, masks, brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1):
+        """ Grayscale(3) and ColorJitter(0.4, 0.4, 0.2, 0.1) as applied by each mask, with the
+        jitter order drawn per sample. Grayscale, brightness, contrast and saturation are affine
+        colour maps, so the ones before the hue shift and the ones after it are each folded into
+        a 3x3 matrix plus offset and applied in one pass, clamping once instead of after every op.
+        """
+        n = x.shape[0]
+        y = x.float().div_(255)
+        gray = self.applies(masks, 'grayscale')
+        jitter = self.applies(masks, 'colorjitter')
+
+        generator = transform_generator(x.device)
+        factors = torch.stack([
+            torch.empty(n, device=x.device).uniform_(1 - brightness, 1 + brightness, generator=generator),
+            torch.empty(n, device=x.device).uniform_(1 - contrast, 1 + contrast, generator=generator),
+            torch.empty(n, device=x.device).uniform_(1 - saturation, 1 + saturation, generator=generator),
+            torch.empty(n, device=x.device).uniform_(-hue, hue, generator=generator)
+        ], dim=1)
+        order = torch.rand(n, 4, device=x.device, generator=generator).argsort(dim=1)
+        hue_step = (order == 3).int().argmax(dim=1)
+
+        weights = torch.tensor(GRAY_WEIGHTS, device=x.device)
+        eye = torch.eye(3, device=x.device).expand(n, 3, 3)
+        matrix = torch.where(gray.view(n, 1, 1), weights.expand(n, 3, 3), eye)
+        offset = torch.zeros(n, 3, device=x.device)
+        matrix, offset = self._jitter(matrix, offset, y.mean(dim=(2, 3)), factors, order,
+                                      jitter.view(n, 1) & (torch.arange(4, device=x.device) < hue_step.view(n, 1)))
+        y = self._affine(y, matrix, offset)
+
+        idx = jitter.nonzero().squeeze(1)
+        if len(idx) > 0:
+            hsv = _rgb2hsv(y.index_select(0, idx))
+            hsv[:, 0] = (hsv[:, 0] + factors[idx, 3].view(-1, 1, 1)) % 1.0
+            y.index_copy_(0, idx, _hsv2rgb(hsv))
+
+            after = jitter.view(n, 1) & (torch.arange(4, device=x.device) > hue_step.view(n, 1))
+            if bool(after.any()):
+                matrix, offset = self._jitter(eye, torch.zeros_like(offset), y.mean(dim=(2, 3)), factors, order, after)
+                y = self._affine(y, matrix, offset)
+
+        return y.mul_(255).round_().to(torch.uint8)
+
+    @staticmethod
+    def _jitter(matrix, offset, mean, factors, order, steps):
+        """ folds the brightness, contrast and saturation steps of each sample that are set in
+        steps [n, 4] into the affine colour map (matrix, offset) acting on images with per-channel
+        mean [n, 3] """
+        n = matrix.shape[0]
+        weights = torch.tensor(GRAY_WEIGHTS, device=matrix.device)
+        eye = torch.eye(3, device=matrix.device).expand(n, 3, 3)
+        for step in range(4):
+            op, f = order[:, step], factors.gather(1, order[:, step:step + 1]).view(n, 1, 1)
+            # contrast blends with the gray mean of the image so far, which the map carries along
+            gray_mean = ((torch.einsum('nij,nj->ni', matrix, mean) + offset) @ weights).view(n, 1)
+            a = torch.where((op == 2).view(n, 1, 1), f * eye + (1 - f) * weights.expand(n, 3, 3), f * eye)
+            c = torch.where((op == 1).view(n, 1), (1 - f.view(n, 1)) * gray_mean, torch.zeros_like(offset))
+            apply = (steps[:, step] & (op != 3)).view(n, 1, 1)
+            matrix = torch.where(apply, a @ matrix, matrix)
+            offset = torch.where(apply.view(n, 1), torch.einsum('nij,nj->ni', a, offset) + c, offset)
+
+        return matrix, offset
+
+    @staticmethod
+    def _affine(y, matrix, offset):
+        return (torch.einsum('nij,njhw->nihw', matrix, y) + offset.view(-1, 3, 1, 1)).clamp_(0, 1)
@@ -0,0 +1,123 @@
+""" pick the loader backend, worker count and prefetch factor that keep up with the model
+
+author seungwook
+"""
+import os
+import copy
+import time
+import socket
+
+import torch
+
+from benchmark import loader_throughput
+from utils import autocast
+from dataset import load_json, update_json
+
+
+def available_cpus():
+    """ cores this process may run on, which cgroups, taskset or SLURM can limit below the machine's """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def train_threads(device, cpus):
+    """ intra-op threads to leave the training step: a cuda step mostly waits on the
+    device, a cpu one keeps half the cores and the loader gets the rest """
+    if torch.device(device).type == 'cuda':
+        return min(2, cpus)
+    return max(1, cpus // 2)
+
+def cache_key(tfs, aug_backend, batch_size):
+    """ key of a tuned configuration, which depends on the host and the augmentation cost """
+    return '{}|{}|{}|{}'.format(socket.gethostname(), ','.join(sorted(tfs)) or 'none', aug_backend, batch_size)
+
+def load_tuned(cache_path, key):
+    """ cached configuration of key, or None """
+    return load_json(cache_path).get(key)
+
+def save_tuned(cache_path, key, config):
+    update_json(cache_path, key, config)
+
+def model_step_time(net, batch_size, device, steps=5, amp='off'):
+    """ seconds per forward and backward pass of net on a batch under the autocast of amp,
+    leaving its state untouched
+    """
+    state = copy.deepcopy(net.state_dict())
+    net.train()
+    images = torch.randn(batch_size, 3, 32, 32, device=device)
+
+    def step():
+        with autocast(device, amp):
+            outputs = net(images)
+        outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+        sum(o.float().mean() for o in outputs).backward()
+        if torch.device(device).type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    step()
+    start = time.time()
+    for _ in range(steps):
+        step()
+    elapsed = (time.time() - start) / steps
+
+    net.zero_grad(set_to_none=True)
+    net.load_state_dict(state)
+    return elapsed
+
+def autotune(make_loader, required, backends=('workers', 'threads', 'ring'), max_workers=None, prefetch_factors=(2, 4),
+             num_batches=10, verbose=True):
+    """ return the cheapest configuration whose loader delivers the required images per second,
+    or the fastest one if none does
+    Args:
+        make_loader: function of (backend, num_workers, prefetch_factor) returning a loader
+        required: images per second the model step consumes
+        backends: loader backends to try, 'memory' augments in this process, so it is
+            only timed once, without workers, and only a fair choice when the
+            batches are augmented on the gpu
+        max_workers: most worker processes or threads to try, defaults to the
+            available cores left over by torch's intra-op threads (set them first)
+        prefetch_factors: batches in flight per worker to try
+        num_batches: batches to time per configuration
+    Returns: dict of loader, num_workers, prefetch_factor and images_per_sec
+    """
+    if max_workers is None:
+        max_workers = max(1, available_cpus() - torch.get_num_threads())
+
+    def measure(backend, num_workers, prefetch_factor):
+        loader = make_loader(backend, num_workers, prefetch_factor)
+        _, throughput = loader_throughput(loader, num_batches)
+        if hasattr(loader, 'close'):
+            loader.close()
+        if verbose:
+            print('autotune: {} with {} workers, prefetch factor {}: {:.0f} images/s'.format(
+                backend, num_workers, prefetch_factor, throughput))
+        return {'loader': backend, 'num_workers': num_workers, 'prefetch_factor': prefetch_factor,
+                'images_per_sec': throughput}
+
+    candidates = []
+    for backend in backends:
+        if backend == 'memory':
+            candidates.append(measure(backend, 0, prefetch_factors[0]))
+            continue
+
+        # double the workers until the loader keeps up or stops getting faster
+        best, num_workers = None, 1
+        while num_workers <= max_workers:
+            config = measure(backend, num_workers, prefetch_factors[0])
+            if best is not None and config['images_per_sec'] < 1.05 * best['images_per_sec']:
+                break
+            best = config
+            if best['images_per_sec'] >= required:
+                break
+            num_workers *= 2
+
+        for prefetch_factor in prefetch_factors[1:]:
+            config = measure(backend, best['num_workers'], prefetch_factor)
+            if config['images_per_sec'] > best['images_per_sec']:
+                best = config
+        candidates.append(best)
+
+    fast_enough = [c for c in candidates if c['images_per_sec'] >= required]
+    if fast_enough:
+        return min(fast_enough, key=lambda c: (c['num_workers'], -c['images_per_sec']))
+    return max(candidates, key=lambda c: c['images_per_sec'])
@@ -0,0 +1,165 @@
+#!/usr/bin/env	python3
+
+""" benchmark the loader backends, or the amp modes of the training step
+
+author seungwook
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+
+from utils import get_training_dataloader, get_test_dataloader, get_all_tf_combs, get_memory_usage, \
+    configure_synthetic, get_network, dataset_num_classes, autocast, grad_scaler
+from dataset import SharedDatasetStore
+from augment import BatchAugment
+
+
+def loader_throughput(loader, num_batches):
+    """ return the seconds until the first batch and the images per second after it """
+    start = time.time()
+    it = iter(loader)
+    next(it)
+    first = time.time() - start
+
+    images, start = 0, time.time()
+    for _, (batch, _, _) in zip(range(num_batches), it):
+        images += len(batch)
+    elapsed = time.time() - start
+
+    return first, images / max(elapsed, 1e-9)
+
+def amp_comparison(make_net, train_batches, test_batches, device, amp, lr=0.1):
+    """ train a network from the same initialization on the same batches under
+    an amp mode, like train.py does, then score it on the test batches
+    Args:
+        make_net: function returning a new network
+        train_batches: list of (images, true_labels, aug_labels) on device
+        test_batches: list of (images, true_labels, aug_labels) on device
+        device: device of the network
+        amp: 'off', 'fp16' or 'bf16'
+        lr: learning rate of SGD
+    Returns: images per second of the training steps after the first one, the
+        last training loss, and the test accuracy of the aug and online heads
+    """
+    if len(train_batches) < 2 or not test_batches:
+        raise ValueError('timing needs at least two training batches and a test batch, got {} and {}'.format(
+            len(train_batches), len(test_batches)))
+    torch.manual_seed(0)
+    net = make_net().to(device)
+    loss_function = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(net.parameters(), lr=lr, momentum=0.9, weight_decay=5e-4)
+    scaler = grad_scaler(device, amp)
+
+    net.train()
+    images_done, start = 0, time.time()
+    for i, (images, true_labels, aug_labels) in enumerate(train_batches):
+        if i == 1:
+            # the first step pays for the lazy initialization
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.time()
+        optimizer.zero_grad()
+        with autocast(device, amp):
+            outputs, outputs_online = net(images)
+            loss = loss_function(outputs, aug_labels) + loss_function(outputs_online, true_labels)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        images_done += len(images) if i > 0 else 0
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = time.time() - start
+
+    net.eval()
+    correct, correct_online, total = 0, 0, 0
+    with torch.no_grad(), autocast(device, amp):
+        for images, true_labels, aug_labels in test_batches:
+            outputs, outputs_online = net(images)
+            correct += outputs.argmax(1).eq(aug_labels).sum().item()
+            correct_online += outputs_online.argmax(1).eq(true_labels).sum().item()
+            total += len(images)
+
+    return images_done / max(elapsed, 1e-9), loss.item(), correct / total, correct_online / total
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='/data/scratch/swhan/data/', help='path to data directory')
+    parser.add_argument('--dataset', type=str, default='cifar100', help='name of dataset (synthetic needs no data on disk)')
+    parser.add_argument('--synthetic-size', type=int, default=50000, help='number of training images of the synthetic dataset')
+    parser.add_argument('--synthetic-classes', type=int, default=100, help='number of classes of the synthetic dataset')
+    parser.add_argument('--batch-size', type=int, default=128, help='batch size for dataloader')
+    parser.add_argument('--tfs',  nargs='+', default=[], help='Choose from [crop, hflip, vflip, rotate, invert, blur, solarize, grayscale, colorjitter]')
+    parser.add_argument('--max-num-tf-combos', type=int, default=-1, help='Maximum number of augmentation combination per class (-1 is all)')
+    parser.add_argument('--aug-backend', type=str, default='pil', choices=['pil', 'tensor', 'batch'], help='as in train.py')
+    parser.add_argument('--cache', action='store_true', default=False, help='memory-map the pre-decoded dataset cache (built on first use)')
+    parser.add_argument('--loaders', nargs='+', default=['workers', 'threads'], choices=['workers', 'ring', 'threads', 'memory'], help='loader backends to compare')
+    parser.add_argument('--num-workers', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help='worker process or thread counts to try')
+    parser.add_argument('--num-batches', type=int, default=50, help='batches to time after the first one')
+    parser.add_argument('--intra-op-threads', type=int, default=None, help='torch intra-op threads of this process')
+    parser.add_argument('--amp', nargs='+', default=None, choices=['off', 'fp16', 'bf16'], help='compare the training step throughput and accuracy of these amp modes instead of the loaders')
+    parser.add_argument('--net', type=str, default='resnet18', help='net type of the amp comparison')
+    parser.add_argument('--gpu', action='store_true', default=False, help='run the amp comparison on the gpu')
+    args = parser.parse_args()
+
+    if args.dataset == 'synthetic':
+        configure_synthetic(train_size=args.synthetic_size, num_classes=args.synthetic_classes)
+    if args.intra_op_threads:
+        torch.set_num_threads(args.intra_op_threads)
+
+    uint8 = args.aug_backend != 'pil'
+    all_tf_combs = get_all_tf_combs(None, None, args.tfs, args.max_num_tf_combos, tensor=uint8,
+                                    dataset=args.dataset, data_dir=args.data)
+    batch_aug = BatchAugment(all_tf_combs, normalize=False) if args.aug_backend == 'batch' else None
+    store = SharedDatasetStore(args.data, args.dataset, cache=args.cache)
+
+    print(f'{len(all_tf_combs)} tf combinations of {args.tfs}, {args.aug_backend} augmentation, '
+          f'batch size {args.batch_size}, {torch.get_num_threads()} intra-op threads')
+
+    if args.amp:
+        if args.num_batches < 2:
+            parser.error('--amp times the training steps after the first one, use --num-batches 2 or more')
+        device = torch.device('cuda' if args.gpu else 'cpu')
+        loaders = [get_training_dataloader(args.data, all_tf_combs, num_workers=args.num_workers[0], batch_size=args.batch_size,
+                                           batch_aug=batch_aug, store=store, uint8=uint8, device=device, seed=0),
+                   get_test_dataloader(args.data, all_tf_combs, num_workers=args.num_workers[0], batch_size=args.batch_size,
+                                       batch_aug=batch_aug, store=store, uint8=uint8, device=device, seed=0)]
+        # every mode trains and tests on the same batches, loaded once up front
+        train_batches, test_batches = [[tuple(t.to(device) for t in batch) for _, batch in zip(range(args.num_batches), loader)]
+                                       for loader in loaders]
+        make_net = lambda: get_network(args, num_classes=len(all_tf_combs), online_num_classes=dataset_num_classes[args.dataset])
+
+        print(f'{args.net} on {device}, {len(train_batches)} training and {len(test_batches)} test batches')
+        print('{:>6} {:>12} {:>8} {:>12} {:>10} {:>12}'.format('amp', 'images/s', 'speedup', 'train loss', 'accuracy', 'online acc'))
+        baseline = None
+        for amp in args.amp:
+            throughput, loss, acc, acc_online = amp_comparison(make_net, train_batches, test_batches, device, amp)
+            baseline = baseline or throughput
+            print('{:>6} {:>12.0f} {:>8.2f} {:>12.4f} {:>10.4f} {:>12.4f}'.format(
+                amp, throughput, throughput / baseline, loss, acc, acc_online))
+        sys.exit(0)
+
+    print('{:>8} {:>8} {:>12} {:>12} {:>12}'.format('loader', 'workers', 'first (s)', 'images/s', 'memory (MB)'))
+    for backend in args.loaders:
+        # the in-memory loader has no workers
+        for num_workers in (args.num_workers if backend != 'memory' else [0]):
+            loader = get_training_dataloader(
+                args.data,
+                all_tf_combs,
+                num_workers=num_workers,
+                batch_size=args.batch_size,
+                shuffle=True,
+                batch_aug=batch_aug,
+                store=store,
+                uint8=uint8,
+                backend=backend
+            )
+            first, throughput = loader_throughput(loader, args.num_batches)
+            resident, _ = get_memory_usage()
+            print('{:>8} {:>8} {:>12.2f} {:>12.0f} {:>12.1f}'.format(backend, num_workers, first, throughput, resident))
+            if hasattr(loader, 'close'):
+                loader.close()
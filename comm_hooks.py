@@ -0,0 +1,242 @@
+""" gradient compression hooks for DistributedDataParallel, counting the bytes and time they communicate
+
+author seungwook
+"""
+import time
+
+import torch
+import torch.distributed as dist
+
+
+class CommStats(object):
+    """
+        Bytes sent and seconds spent in collectives, for the current step
+        (until step() is called) and in total since the last reset().
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.bytes, self.time, self.steps = 0, 0.0, 0
+        self.step_bytes, self.step_time = 0, 0.0
+
+    def add(self, nbytes, seconds):
+        self.step_bytes += nbytes
+        self.step_time += seconds
+
+    def step(self):
+        """ close the current step, return its bytes and seconds """
+        step = self.step_bytes, self.step_time
+        self.bytes += self.step_bytes
+        self.time += self.step_time
+        self.steps += 1
+        self.step_bytes, self.step_time = 0, 0.0
+        return step
+
+
+class HookState(object):
+    """
+        State of a comm hook: its process group and the CommStats it records to.
+    Args:
+        process_group: group to communicate in, defaults to the whole world
+    """
+    def __init__(self, process_group=None):
+        self.process_group = process_group
+        self.world_size = dist.get_world_size(process_group)
+        self.stats = CommStats()
+        self.iteration = 0
+
+
+class PowerSGDState(HookState):
+    """
+        State of powersgd_hook: the rank of the approximation, and per bucket the
+        error feedback and the Q factors reused as the next step's warm start.
+    Args:
+        process_group: group to communicate in, defaults to the whole world
+        rank: rank of the low-rank approximation of each gradient matrix
+        seed: seed of the initial Q factors, the same on every rank
+    """
+    def __init__(self, process_group=None, rank=2, seed=0):
+        super().__init__(process_group)
+        self.rank = rank
+        self.generator = torch.Generator().manual_seed(seed)
+        self.errors = {}
+        self.qs = {}
+
+
+class TopKState(HookState):
+    """
+        State of topk_hook: the fraction of each bucket to send, and per bucket
+        the error feedback of what was not sent.
+    Args:
+        process_group: group to communicate in, defaults to the whole world
+        ratio: fraction of the largest gradient entries sent each step
+    """
+    def __init__(self, process_group=None, ratio=0.01):
+        super().__init__(process_group)
+        self.ratio = ratio
+        self.errors = {}
+
+
+def _all_reduce(state, tensor):
+    """ future of tensor summed over the ranks, counted in state.stats """
+    start = time.time()
+    fut = dist.all_reduce(tensor, group=state.process_group, async_op=True).get_future()
+
+    def done(fut):
+        state.stats.add(tensor.numel() * tensor.element_size(), time.time() - start)
+        return fut.value()[0]
+
+    return fut.then(done)
+
+def _all_gather(state, tensor):
+    """ future of the list of tensor of every rank, counted in state.stats """
+    start = time.time()
+    gathered = [torch.empty_like(tensor) for _ in range(state.world_size)]
+    fut = dist.all_gather(gathered, tensor, group=state.process_group, async_op=True).get_future()
+
+    def done(fut):
+        state.stats.add(tensor.numel() * tensor.element_size(), time.time() - start)
+        return gathered
+
+    return fut.then(done)
+
+def _buffer_for(tensors, key, like):
+    """ tensors[key], (re)created as zeros like like when missing or when DDP rebuilt the bucket """
+    if key not in tensors or tensors[key].shape != like.shape:
+        tensors[key] = torch.zeros_like(like)
+    return tensors[key]
+
+def _first_iteration(state, bucket):
+    """ whether this is the first step, which DDP follows by rebuilding its buckets in a new
+    layout: the hooks keeping state per bucket average it uncompressed and start after it """
+    first = state.iteration == 0
+    if bucket.is_last():
+        state.iteration += 1
+    return first
+
+def allreduce_hook(state, bucket):
+    """ uncompressed average, what DDP does without a hook, but counted """
+    return _all_reduce(state, bucket.buffer().div_(state.world_size))
+
+def compress_hook(dtype):
+    """ hook averaging the gradients cast to dtype (float16 or bfloat16), half the bytes of fp32 """
+    def hook(state, bucket):
+        buffer = bucket.buffer()
+        compressed = buffer.to(dtype).div_(state.world_size)
+
+        def decompress(fut):
+            buffer.copy_(fut.value())
+            return buffer
+
+        return _all_reduce(state, compressed).then(decompress)
+
+    return hook
+
+def powersgd_hook(state, bucket):
+    """ PowerSGD (Vogels et al., 2019): rank-r approximations P Q^T of the averaged gradient
+    matrices, with error feedback and Q reused as the next warm start, the vectors and small
+    matrices are averaged as is """
+    if _first_iteration(state, bucket):
+        return allreduce_hook(state, bucket)
+    buffer, index = bucket.buffer(), bucket.index()
+    error = _buffer_for(state.errors, index, buffer)
+    buffer.add_(error)
+    error.copy_(buffer)
+
+    matrices, uncompressed, exact = [], [], []
+    offset = 0
+    for grad in bucket.gradients():
+        matrix = grad.view(grad.shape[0], -1) if grad.dim() > 1 else None
+        if matrix is not None and state.rank * sum(matrix.shape) < matrix.numel():
+            matrices.append(matrix)
+        else:
+            uncompressed.append(grad)
+            exact.append(error[offset:offset + grad.numel()])
+        offset += grad.numel()
+
+    qs = []
+    for i, matrix in enumerate(matrices):
+        if state.qs.get((index, i)) is None or state.qs[(index, i)].shape != (matrix.shape[1], state.rank):
+            state.qs[(index, i)] = torch.randn(matrix.shape[1], state.rank, generator=state.generator).to(matrix)
+        qs.append(state.qs[(index, i)])
+
+    ps = [matrix @ q for matrix, q in zip(matrices, qs)]
+    flat = torch.cat([g.flatten() / state.world_size for g in uncompressed] + [p.flatten() for p in ps])
+
+    def compute_qs(fut):
+        flat = fut.value()
+        offset = 0
+        for grad in uncompressed:
+            grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+            offset += grad.numel()
+        for i, p in enumerate(ps):
+            ps[i] = torch.linalg.qr(flat[offset:offset + p.numel()].view_as(p)).Q
+            offset += p.numel()
+
+        if matrices:
+            new_qs = torch.cat([(matrix.t() @ p).flatten() for matrix, p in zip(matrices, ps)])
+            new_qs = _all_reduce(state, new_qs).wait().div_(state.world_size)
+            offset = 0
+            for i, (matrix, p) in enumerate(zip(matrices, ps)):
+                q = new_qs[offset:offset + qs[i].numel()].view_as(qs[i])
+                offset += q.numel()
+                state.qs[(index, i)] = q
+                matrix.copy_(p @ q.t())
+
+        # only the compressed matrices carry an error, the rest was sent exactly
+        error.sub_(buffer)
+        for e in exact:
+            e.zero_()
+        return buffer
+
+    return _all_reduce(state, flat).then(compute_qs)
+
+def topk_hook(state, bucket):
+    """ top-k sparsification: every rank sends the ratio largest entries of its bucket as values
+    and indices, the ones not sent are added back at the next step (error feedback) """
+    if _first_iteration(state, bucket):
+        return allreduce_hook(state, bucket)
+    buffer, index = bucket.buffer(), bucket.index()
+    error = _buffer_for(state.errors, index, buffer)
+    buffer.add_(error)
+
+    k = max(1, int(buffer.numel() * state.ratio))
+    _, indices = buffer.abs().topk(k, sorted=False)
+    values = buffer[indices]
+    error.copy_(buffer)
+    error[indices] = 0
+
+    fut_values = _all_gather(state, values)
+    fut_indices = _all_gather(state, indices)
+
+    def decompress(fut):
+        buffer.zero_()
+        for rank_values, rank_indices in zip(fut.value(), fut_indices.wait()):
+            buffer.index_add_(0, rank_indices, rank_values)
+        return buffer.div_(state.world_size)
+
+    return fut_values.then(decompress)
+
+# hook and state of each --comm-hook
+comm_hooks = {
+    'allreduce': (allreduce_hook, HookState),
+    'fp16': (compress_hook(torch.float16), HookState),
+    'bf16': (compress_hook(torch.bfloat16), HookState),
+    'powersgd': (powersgd_hook, PowerSGDState),
+    'topk': (topk_hook, TopKState)
+}
+
+def register_comm_hook(ddp_model, name, process_group=None, **kwargs):
+    """ register the comm hook name on a DistributedDataParallel model
+    Args:
+        ddp_model: the DistributedDataParallel model
+        name: key of comm_hooks
+        process_group: group to communicate in, defaults to the whole world
+        kwargs: arguments of the state, e.g. rank of PowerSGDState or ratio of TopKState
+    Returns: the state of the hook, whose stats count its communication
+    """
+    hook, state_class = comm_hooks[name]
+    state = state_class(process_group, **kwargs)
+    ddp_model.register_comm_hook(state, hook)
+    return state
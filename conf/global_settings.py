@@ -42,3 +42,9 @@ SAVE_EPOCH = 10
 
 
 
+
+#loader configurations picked by --autotune, per host, tfs and batch size
+AUTOTUNE_CACHE = 'autotune.json'
+
+#mean and std of the datasets without hard-coded ones, computed on first use
+STATS_CACHE = 'dataset_stats.json'
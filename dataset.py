@@ -4,60 +4,523 @@ author baiyu
 """
 import os
 import sys
+import json
+import fcntl
 import pickle
+import argparse
+import threading
+import contextlib
 
 from skimage import io
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+import torch.distributed as dist
+from PIL import Image
+from torch.utils.data import Dataset, Sampler
 from torchvision.datasets import CIFAR10, CIFAR100
 
+# sizes, class count and seed of the synthetic dataset (see SyntheticDataset)
+synthetic_config = {
+    'train_size': 50000,
+    'test_size': 10000,
+    'num_classes': 100,
+    'seed': 0
+}
+
+def keyed_rng(seed, epoch, idx=-1, stream=0):
+    """ counter-based (Philox) generator keyed on (seed, epoch, sample index),
+    so the same sample in the same epoch draws the same numbers in whichever
+    worker process it lands, and any part of an epoch can be replayed. idx=-1
+    gives the stream of the epoch itself, stream > 0 the repeats of data echoing
+    (see loader.EchoingLoader), idx then indexing batches
+    """
+    key = ((seed % 2 ** 64) << 64) | ((stream % 2 ** 16) << 48) | ((epoch % 2 ** 16) << 32) | (idx + 1)
+    return np.random.Generator(np.random.Philox(key=key))
+
+# seed of the sample being transformed in each thread and its generator per device (see transform_generator)
+_transform_rng = threading.local()
+
+def transform_generator(device='cpu'):
+    """ torch.Generator on device the random transformations draw their parameters from,
+    seeded on the sample last passed to AugmentedDataset.seed_transform in this thread, so
+    they never touch (nor race on) the global random state. None, i.e. the global random
+    state, outside a seeded dataset
+    """
+    seed = getattr(_transform_rng, 'seed', None)
+    if seed is None:
+        return None
+    device = torch.device(device)
+    if device not in _transform_rng.generators:
+        _transform_rng.generators[device] = torch.Generator(device).manual_seed(seed)
+    return _transform_rng.generators[device]
+
+def seed_transform_generator(seed):
+    """ seed transform_generator in this thread, None for the global random state """
+    _transform_rng.seed = seed
+    _transform_rng.generators = {}
+
+def get_cache_dir(root, dataset='cifar100'):
+    """ default location of the pre-decoded cache of a dataset """
+    return os.path.join(root, '{}-npy'.format(dataset))
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    """ file to write path through, a temporary file that only replaces path once it is
+    fully written, so that concurrent runs (or a preempted one) never see a partial file """
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_json(path):
+    """ the json dict at path, empty if there is none yet """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def update_json(path, key, value):
+    """ set key to value in the json dict at path. The dict is re-read and rewritten under
+    an exclusive lock on path.lock, so concurrent runs keep each other's keys """
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = load_json(path)
+        entries[key] = value
+        with atomic_write(path) as f:
+            json.dump(entries, f, indent=2)
+
+def save_npy(path, array):
+    """ np.save that never leaves a partially written file at path """
+    with atomic_write(path, 'wb') as f:
+        np.save(f, array)
+
+def build_cache(root, dataset='cifar100', cache_dir=None):
+    """ one-time conversion of a dataset into memory-mappable .npy files
+    Args:
+        root: path to data directory
+        dataset: name of dataset in dataset_names
+        cache_dir: where to write the cache, defaults to get_cache_dir(root, dataset)
+    Returns: the cache directory, holding {split}_data.npy (NHWC uint8),
+        {split}_targets.npy (int64) for split in train/test, and meta.json
+    """
+    cache_dir = cache_dir or get_cache_dir(root, dataset)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    for split, train in [('train', True), ('test', False)]:
+        ds = dataset_names[dataset](root, train=train)
+        save_npy(os.path.join(cache_dir, '{}_data.npy'.format(split)), np.ascontiguousarray(ds.data, dtype=np.uint8))
+        save_npy(os.path.join(cache_dir, '{}_targets.npy'.format(split)), np.asarray(ds.targets, dtype=np.int64))
+
+    with atomic_write(os.path.join(cache_dir, 'meta.json')) as f:
+        json.dump({'dataset': dataset, 'classes': ds.classes}, f)
+
+    return cache_dir
+
+def load_cache(cache_dir, train=False):
+    """ return read-only memory maps of the images and labels of a cached split """
+    split = 'train' if train else 'test'
+    data = np.load(os.path.join(cache_dir, '{}_data.npy'.format(split)), mmap_mode='r')
+    targets = np.load(os.path.join(cache_dir, '{}_targets.npy'.format(split)), mmap_mode='r')
+
+    return data, targets
+
+
+class ArrayDataset(Dataset):
+    """
+        Dataset split held as an NHWC uint8 image array and an int64 label array,
+        with the same data/targets/classes interface as torchvision's CIFAR datasets.
+    """
+    def __init__(self, data, targets, classes):
+        self.data = data
+        self.targets = targets
+        self.classes = classes
+
+    def __getitem__(self, idx):
+        return Image.fromarray(self.data[idx]), int(self.targets[idx])
+
+    def __len__(self):
+        return len(self.data)
+
+
+class SyntheticDataset(ArrayDataset):
+    """
+        CIFAR-shaped split of random uint8 images and labels, drawn from a fixed
+        seed so every process and every run gets the same ones, to measure the
+        loader and model throughput without any data on disk. Its sizes, class
+        count and seed are taken from synthetic_config.
+    Args:
+        root: unused, for the same signature as the torchvision datasets
+        train: whether to return the train or the test split
+    """
+    def __init__(self, root=None, train=False):
+        size = synthetic_config['train_size' if train else 'test_size']
+        num_classes = synthetic_config['num_classes']
+        rng = np.random.default_rng((synthetic_config['seed'], int(train)))
+        data = rng.integers(0, 256, (size, 32, 32, 3), dtype=np.uint8)
+        targets = rng.integers(0, num_classes, size)
+        super().__init__(data, targets, ['class_{}'.format(c) for c in range(num_classes)])
+
+
 dataset_names = {
     'cifar10': CIFAR10,
-    'cifar100': CIFAR100
+    'cifar100': CIFAR100,
+    'synthetic': SyntheticDataset
 }
 
+
+class CachedDataset(ArrayDataset):
+    """
+        Dataset split memory-mapped from the cache written by build_cache. The
+        pages are shared by every worker and every concurrent run on the node.
+    """
+    def __init__(self, root, train=False, dataset='cifar100', cache_dir=None):
+        self.cache_dir = cache_dir or get_cache_dir(root, dataset)
+        self.train = train
+        if not os.path.exists(os.path.join(self.cache_dir, 'meta.json')):
+            build_cache(root, dataset, self.cache_dir)
+
+        self._load()
+
+    def _load(self):
+        data, targets = load_cache(self.cache_dir, train=self.train)
+        with open(os.path.join(self.cache_dir, 'meta.json')) as f:
+            classes = json.load(f)['classes']
+        super().__init__(data, targets, classes)
+
+    def __getstate__(self):
+        # spawned workers re-open the memory maps instead of receiving a copy
+        return {'cache_dir': self.cache_dir, 'train': self.train}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load()
+
+
+class SharedArrayDataset(ArrayDataset):
+    """
+        ArrayDataset backed by tensors in shared memory, which reach spawned
+        workers as shared memory handles instead of being copied.
+    """
+    def __init__(self, data, targets, classes):
+        self.tensors = (
+            torch.from_numpy(np.ascontiguousarray(data, dtype=np.uint8)).share_memory_(),
+            torch.from_numpy(np.asarray(targets, dtype=np.int64)).share_memory_()
+        )
+        super().__init__(self.tensors[0].numpy(), self.tensors[1].numpy(), classes)
+
+    def __getstate__(self):
+        return {'tensors': self.tensors, 'classes': self.classes}
+
+    def __setstate__(self, state):
+        self.tensors = state['tensors']
+        super().__init__(self.tensors[0].numpy(), self.tensors[1].numpy(), state['classes'])
+
+
+class SharedDatasetStore(object):
+    """
+        Decodes each split of a dataset once per process tree and keeps it in
+        shared memory (or in the memory-mapped cache). Every AugmentedDataset
+        built on the store is a view over the same pages, differing only in
+        transform list and split, and its labels are numpy arrays rather than
+        refcounted Python ints, so forked workers don't trigger copy-on-write.
+    """
+    def __init__(self, root, dataset='cifar100', cache=False):
+        self.root = root
+        self.dataset = dataset
+        self.cache = cache
+        self.splits = {}
+
+    def split(self, train=False):
+        """ return the shared ArrayDataset of the train or test split """
+        if train not in self.splits:
+            if self.cache:
+                self.splits[train] = CachedDataset(self.root, train=train, dataset=self.dataset)
+            else:
+                ds = dataset_names[self.dataset](self.root, train=train)
+                self.splits[train] = SharedArrayDataset(ds.data, ds.targets, ds.classes)
+
+        return self.splits[train]
+
+    def nbytes(self):
+        """ total size of the decoded splits in bytes """
+        return sum(ds.data.nbytes + ds.targets.nbytes for ds in self.splits.values())
+
+
 class AugmentedDataset(Dataset):
     """
         Augmented version of any img dataset that uses different sets of 
         transformations and assigns labels based on which set/family
         they were created from.
+
+        raw and tensor keep img a uint8 [3, H, W] tensor for batch augmentation
+        or collate-time normalization, cache/store pick where the images come
+        from, seed draws labels and tf parameters from keyed_rng, and num_views
+        returns every image as that many views with distinct aug labels.
     """
-    def __init__(self, root, dataset='cifar100', transform_list=None, train=False):
-        self.dataset = dataset_names[dataset](root, train=train)
+    def __init__(self, root, dataset='cifar100', transform_list=None, train=False, raw=False, cache=False,
+                 store=None, seed=None, tensor=False, num_views=1):
+        if store is not None:
+            self.dataset = store.split(train)
+        elif cache:
+            self.dataset = CachedDataset(root, train=train, dataset=dataset)
+        else:
+            self.dataset = dataset_names[dataset](root, train=train)
+        self.targets = np.asarray(self.dataset.targets, dtype=np.int64)
         self.transform_list = transform_list
         self.num_transform = len(self.transform_list)
+        if not 1 <= num_views <= self.num_transform:
+            raise ValueError('num_views must be between 1 and the {} tf combinations'.format(self.num_transform))
+        self.num_views = num_views
+        self.raw = raw
+        self.tensor = tensor
+        self.seed = seed
+        # in shared memory so that already running (persistent) workers see set_epoch
+        self.epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.epoch_aug_labels = (None, None)
+
+    def set_epoch(self, epoch):
+        self.epoch[0] = epoch
+
+    def draw_aug_labels(self, n, rng=None):
+        """ n aug labels, or with num_views an [n, num_views] array of n rows of
+        distinct ones, drawn from rng or from the global random state
+        """
+        integers = rng.integers if rng is not None else np.random.randint
+        if self.num_views == 1:
+            return integers(0, self.num_transform, n)
+
+        # Floyd's sampling without replacement, one column per step for all rows at once
+        labels = np.empty((n, self.num_views), dtype=np.int64)
+        for col, high in enumerate(range(self.num_transform - self.num_views, self.num_transform)):
+            label = integers(0, high + 1, n)
+            taken = (labels[:, :col] == label[:, None]).any(1)
+            labels[:, col] = np.where(taken, high, label)
+        # Floyd's picks the sets uniformly but not the order within them
+        keys = rng.random(labels.shape) if rng is not None else np.random.random(labels.shape)
+        return np.take_along_axis(labels, keys.argsort(1), 1)
+
+    def get_aug_labels(self, indices):
+        """ aug labels of the given indices, keyed on (seed, epoch, idx) """
+        epoch = int(self.epoch[0])
+        if self.epoch_aug_labels[0] != epoch:
+            self.epoch_aug_labels = (epoch, self.draw_aug_labels(len(self), keyed_rng(self.seed, epoch)))
+
+        return self.epoch_aug_labels[1][indices]
+
+    def seed_transform(self, idx):
+        """ key the transformation parameters of the sample (or batch) at idx, drawn from
+        transform_generator in this thread, on (seed, epoch, idx) """
+        if self.seed is None:
+            seed_transform_generator(None)
+        else:
+            seed_transform_generator(int(keyed_rng(self.seed, int(self.epoch[0]), int(idx)).integers(2 ** 63)))
 
     def __getitem__(self, idx):
-        img, true_label = self.dataset[idx]
-        
-        if self.transform_list:
-            aug_label = np.random.randint(0, self.num_transform, 1)[0]
-            transform = self.transform_list[aug_label]
-            img = transform(img)
+        aug_label = None
+        if isinstance(idx, tuple):
+            idx, aug_label = idx
+
+        if self.raw or self.tensor:
+            img = torch.tensor(self.dataset.data[idx]).permute(2, 0, 1)
+            true_label = self.targets[idx]
+        else:
+            img, true_label = self.dataset[idx]
         
-        return img, true_label, aug_label
+        if not self.transform_list:
+            return img, true_label, aug_label
+
+        if aug_label is None and self.seed is not None:
+            aug_label = self.get_aug_labels(idx)
+        elif aug_label is None:
+            aug_label = self.draw_aug_labels(1)[0]
+        if not self.raw:
+            # the views of a sample draw their parameters one after the other from this seed
+            self.seed_transform(idx)
+
+        if np.ndim(aug_label) == 0:
+            return self.apply(img, aug_label), true_label, aug_label
+        return [(self.apply(img, label), true_label, label) for label in aug_label]
+
+    def apply(self, img, aug_label):
+        """ img transformed by the tf combination of aug_label, or as is in raw mode """
+        if self.raw:
+            return img
+        transform = self.transform_list[aug_label]
+        return transform(img)
+
+    def __getitems__(self, indices):
+        """ batched fetch used by the DataLoader, in raw mode returns the whole
+        batch as (images, true_labels, aug_labels) tensors without creating
+        any per-sample objects
+        """
+        if not self.raw:
+            items = [self[idx] for idx in indices]
+            return items if self.num_views == 1 else [view for views in items for view in views]
+
+        if isinstance(indices[0], tuple):
+            indices, aug_labels = np.asarray(indices, dtype=np.int64).T
+        elif self.seed is not None:
+            indices = np.asarray(indices)
+            aug_labels = self.get_aug_labels(indices)
+        else:
+            indices = np.asarray(indices)
+            aug_labels = self.draw_aug_labels(len(indices))
+
+        # the batch is augmented in the collate right after, in this same thread
+        self.seed_transform(indices[0])
+        images = torch.from_numpy(self.dataset.data[indices]).permute(0, 3, 1, 2)
+        true_labels = torch.from_numpy(self.targets[indices])
+        aug_labels = torch.from_numpy(np.ascontiguousarray(aug_labels))
+        if aug_labels.dim() > 1:
+            # each image is read once and repeated for its views
+            images = images.repeat_interleave(self.num_views, 0)
+            true_labels = true_labels.repeat_interleave(self.num_views, 0)
+            aug_labels = aug_labels.flatten()
+
+        return images, true_labels, aug_labels
     
     def __len__(self):
         return len(self.dataset)
-    
+
+
+class ResumableBatchSampler(Sampler):
+    """
+        Batch sampler whose order in each epoch only depends on (seed, epoch),
+        so an epoch interrupted after some batches can be resumed at the exact
+        next batch (see state_dict). Like DistributedSampler, each rank gets its
+        own shard of the epoch when torch.distributed is initialized.
+    Args:
+        num_samples: size of the dataset
+        batch_size: number of samples per batch
+        shuffle: whether to shuffle the samples every epoch
+        drop_last: whether to drop the last incomplete batch
+        num_replicas: number of ranks, defaults to the world size
+        rank: rank of this process, defaults to the current rank
+        seed: base seed of the per-epoch permutations, shared by all ranks
+    """
+    def __init__(self, num_samples, batch_size, shuffle=True, drop_last=False, num_replicas=None, rank=None,
+                 seed=None):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.epoch = 0
+        self.start_batch = 0
+
+        # every rank gets the same number of samples, padded by wrapping around
+        self.num_rank_samples = -(-num_samples // num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def state_dict(self, batches_done):
+        """ position after the first batches_done batches of the current epoch """
+        return {'seed': self.seed, 'epoch': self.epoch, 'batches_done': batches_done}
+
+    def load_state_dict(self, state):
+        """ the next iteration starts at the saved position """
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.start_batch = state['batches_done']
+
+    def shard(self, array):
+        total_size = self.num_rank_samples * self.num_replicas
+        return np.resize(array, total_size)[self.rank:total_size:self.num_replicas]
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        indices = rng.permutation(self.num_samples) if self.shuffle else np.arange(self.num_samples)
+        indices = self.shard(indices)
+
+        start_batch, self.start_batch = self.start_batch, 0
+        for start in range(start_batch * self.batch_size, len(self) * self.batch_size, self.batch_size):
+            yield indices[start:start + self.batch_size].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_rank_samples // self.batch_size
+        return -(-self.num_rank_samples // self.batch_size)
+
+
+class AugLabelBatchSampler(ResumableBatchSampler):
+    """
+        Batch sampler that assigns the aug label of every sample when the epoch
+        starts, and yields batches of (idx, aug_label) pairs sorted by aug label,
+        so that each tf combination runs once on a contiguous sub-batch (see
+        augment.BatchAugment).
+    Args:
+        num_samples: size of the dataset
+        num_aug: number of tf combinations (aug labels)
+        batch_size: number of samples per batch
+        balanced: assign every aug label equally often per epoch instead of
+            drawing them uniformly at random per sample
+        the rest as in ResumableBatchSampler
+    """
+    def __init__(self, num_samples, num_aug, batch_size, shuffle=True, balanced=False, drop_last=False,
+                 num_replicas=None, rank=None, seed=None):
+        super().__init__(num_samples, batch_size, shuffle=shuffle, drop_last=drop_last,
+                         num_replicas=num_replicas, rank=rank, seed=seed)
+        self.num_aug = num_aug
+        self.balanced = balanced
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        indices = rng.permutation(self.num_samples) if self.shuffle else np.arange(self.num_samples)
+        if self.balanced:
+            aug_labels = rng.permutation(np.resize(np.arange(self.num_aug), self.num_samples))
+        else:
+            aug_labels = rng.integers(0, self.num_aug, self.num_samples)
+        indices, aug_labels = self.shard(indices), self.shard(aug_labels)
+
+        start_batch, self.start_batch = self.start_batch, 0
+        for start in range(start_batch * self.batch_size, len(self) * self.batch_size, self.batch_size):
+            batch_indices = indices[start:start + self.batch_size]
+            batch_aug_labels = aug_labels[start:start + self.batch_size]
+            order = np.argsort(batch_aug_labels, kind='stable')
+            yield list(zip(batch_indices[order].tolist(), batch_aug_labels[order].tolist()))
+
 
 class CIFAR100Train(Dataset):
     """cifar100 test dataset, derived from
     torch.utils.data.DataSet
     """
 
-    def __init__(self, path, transform=None):
+    def __init__(self, path, transform=None, cache_dir=None):
         #if transform is given, we transoform data using
-        with open(os.path.join(path, 'train'), 'rb') as cifar100:
-            self.data = pickle.load(cifar100, encoding='bytes')
+        #if cache_dir is given, we memory-map the images written by build_cache
+        self.images = None
+        if cache_dir:
+            self.images, self.labels = load_cache(cache_dir, train=True)
+        else:
+            with open(os.path.join(path, 'train'), 'rb') as cifar100:
+                self.data = pickle.load(cifar100, encoding='bytes')
         self.transform = transform
 
     def __len__(self):
+        if self.images is not None:
+            return len(self.labels)
         return len(self.data['fine_labels'.encode()])
 
     def __getitem__(self, index):
+        if self.images is not None:
+            label, image = int(self.labels[index]), self.images[index]
+            if self.transform:
+                image = self.transform(image)
+            return label, image
+
         label = self.data['fine_labels'.encode()][index]
         r = self.data['data'.encode()][index, :1024].reshape(32, 32)
         g = self.data['data'.encode()][index, 1024:2048].reshape(32, 32)
@@ -73,15 +536,27 @@ class CIFAR100Test(Dataset):
     torch.utils.data.DataSet
     """
 
-    def __init__(self, path, transform=None):
-        with open(os.path.join(path, 'test'), 'rb') as cifar100:
-            self.data = pickle.load(cifar100, encoding='bytes')
+    def __init__(self, path, transform=None, cache_dir=None):
+        self.images = None
+        if cache_dir:
+            self.images, self.labels = load_cache(cache_dir, train=False)
+        else:
+            with open(os.path.join(path, 'test'), 'rb') as cifar100:
+                self.data = pickle.load(cifar100, encoding='bytes')
         self.transform = transform
 
     def __len__(self):
+        if self.images is not None:
+            return len(self.labels)
         return len(self.data['data'.encode()])
 
     def __getitem__(self, index):
+        if self.images is not None:
+            label, image = int(self.labels[index]), self.images[index]
+            if self.transform:
+                image = self.transform(image)
+            return label, image
+
         label = self.data['fine_labels'.encode()][index]
         r = self.data['data'.encode()][index, :1024].reshape(32, 32)
         g = self.data['data'.encode()][index, 1024:2048].reshape(32, 32)
@@ -92,3 +567,13 @@ class CIFAR100Test(Dataset):
             image = self.transform(image)
         return label, image
 
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='convert a dataset into the memory-mappable cache')
+    parser.add_argument('--data', type=str, default='/data/scratch/swhan/data/', help='path to data directory')
+    parser.add_argument('--dataset', type=str, default='cifar100', help='name of dataset')
+    parser.add_argument('--cache-dir', type=str, default=None, help='where to write the cache (default: <data>/<dataset>-npy)')
+    args = parser.parse_args()
+
+    print('cache written to {}'.format(build_cache(args.data, args.dataset, args.cache_dir)))
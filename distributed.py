@@ -0,0 +1,93 @@
+""" data-parallel training across processes
+
+author seungwook
+"""
+import os
+import builtins
+import subprocess
+
+import torch
+import torch.distributed as dist
+
+
+def launcher_env():
+    """ (rank, world_size, local_rank) set by torchrun or SLURM, or None when not launched by either """
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        return int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), int(os.environ.get('LOCAL_RANK', 0))
+    if 'SLURM_PROCID' in os.environ and int(os.environ.get('SLURM_NTASKS', 1)) > 1:
+        if 'MASTER_ADDR' not in os.environ:
+            # the first node of the job hosts the rendezvous
+            nodes = subprocess.check_output(['scontrol', 'show', 'hostnames', os.environ['SLURM_JOB_NODELIST']])
+            os.environ['MASTER_ADDR'] = nodes.decode().split()[0]
+        os.environ.setdefault('MASTER_PORT', str(29500 + int(os.environ.get('SLURM_JOB_ID', 0)) % 1000))
+        return int(os.environ['SLURM_PROCID']), int(os.environ['SLURM_NTASKS']), int(os.environ.get('SLURM_LOCALID', 0))
+    return None
+
+def init_distributed(gpu=False, backend=None):
+    """ join the process group of the launcher, if any
+    Args:
+        gpu: whether each process trains on the gpu of its local rank
+        backend: process group backend, defaults to nccl on gpus and gloo on cpus
+    Returns: (rank, world_size, local_rank), (0, 1, 0) without a launcher
+    """
+    env = launcher_env()
+    if env is None:
+        return 0, 1, 0
+
+    rank, world_size, local_rank = env
+    if gpu:
+        torch.cuda.set_device(local_rank)
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    dist.init_process_group(backend or ('nccl' if gpu else 'gloo'), rank=rank, world_size=world_size)
+    return rank, world_size, local_rank
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def all_reduce_sum(tensor):
+    """ sum tensor across the ranks in place, and return it """
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+def broadcast_object(obj, src=0):
+    """ obj of rank src on every rank """
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+def silence_other_ranks():
+    """ only rank 0 prints, unless print is called with force=True """
+    builtin_print = builtins.print
+    main = is_main_process()
+
+    def print(*args, force=False, **kwargs):
+        if main or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+class NullWriter(object):
+    """
+        Stands in for the SummaryWriter on ranks other than 0, so that only rank
+        0 writes TensorBoard logs while the training code logs unconditionally.
+    """
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
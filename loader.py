@@ -0,0 +1,608 @@
+""" loaders that do not go through torch.utils.data.DataLoader
+
+author seungwook
+"""
+import os
+import copy
+import time
+import queue
+import shutil
+import itertools
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data.dataloader import default_collate
+
+from dataset import save_npy, keyed_rng, seed_transform_generator, AugLabelBatchSampler
+from augment import collate_raw
+
+FIELDS = ('images', 'true_labels', 'aug_labels')
+
+# dataset and collate_fn of a render worker, set once when the worker starts
+_render_state = {}
+
+
+class TensorLoader(object):
+    """
+        Worker-free loader holding the split as one uint8 tensor (on the device
+        if given), slicing and augmenting each batch in this process.
+    Args:
+        dataset: AugmentedDataset to load, its aug labels and transformation
+            seeds are used as is
+        batch_aug: augment.BatchAugment applying the tf combinations, or None
+        batch_size: number of samples per batch
+        shuffle: whether to shuffle the samples every epoch
+        batch_sampler: sampler of the batches (see utils.get_batch_sampler),
+            instead of a permutation of its own
+        device: device to keep the split on and augment it on
+    """
+    def __init__(self, dataset, batch_aug, batch_size=16, shuffle=True, batch_sampler=None, device=None):
+        self.dataset = dataset
+        self.batch_aug = batch_aug
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.batch_sampler = batch_sampler
+        self.device = device
+        # same contract as a DataLoader over the dataset in raw mode
+        self.collate_fn = batch_aug.collate if batch_aug else collate_raw
+
+        data = dataset.dataset.data
+        if not data.flags.writeable:
+            # read-only memory map of the cache, load it once
+            data = np.array(data)
+        self.images = torch.from_numpy(data).permute(0, 3, 1, 2)
+        self.targets = torch.from_numpy(dataset.targets)
+        if device is not None:
+            self.images = self.images.to(device)
+            self.targets = self.targets.to(device)
+
+    def batches(self):
+        """ indices and aug labels of every batch of the epoch, as tensors """
+        if self.batch_sampler is not None:
+            for batch in self.batch_sampler:
+                if isinstance(batch[0], tuple):
+                    indices, aug_labels = torch.tensor(batch).T
+                elif self.dataset.seed is not None:
+                    indices = torch.tensor(batch)
+                    aug_labels = torch.from_numpy(self.dataset.get_aug_labels(np.asarray(batch)))
+                else:
+                    indices = torch.tensor(batch)
+                    aug_labels = torch.from_numpy(self.dataset.draw_aug_labels(len(batch)))
+                yield indices, aug_labels
+            return
+
+        n = len(self.dataset)
+        order = torch.randperm(n) if self.shuffle else torch.arange(n)
+        for start in range(0, n, self.batch_size):
+            indices = order[start:start + self.batch_size]
+            yield indices, torch.from_numpy(self.dataset.draw_aug_labels(len(indices)))
+
+    def __iter__(self):
+        for indices, aug_labels in self.batches():
+            if aug_labels.dim() > 1:
+                # one row per view of each sample, see AugmentedDataset num_views
+                indices = indices.repeat_interleave(aug_labels.shape[1])
+                aug_labels = aug_labels.flatten()
+            self.dataset.seed_transform(int(indices[0]))
+            if self.device is not None:
+                indices = indices.to(self.device)
+                aug_labels = aug_labels.to(self.device)
+            images = self.images.index_select(0, indices)
+            if self.batch_aug is not None:
+                images = self.batch_aug(images, aug_labels)
+            yield images, self.targets.index_select(0, indices), aug_labels
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        return -(-len(self.dataset) // self.batch_size)
+
+
+def _render(dataset, collate_fn, batches):
+    """ (images, true_labels, aug_labels) of each batch, exactly as a DataLoader would collate them """
+    for batch in batches:
+        if hasattr(dataset, '__getitems__'):
+            yield collate_fn(dataset.__getitems__(batch))
+        else:
+            yield collate_fn([dataset[idx] for idx in batch])
+
+def _reseed():
+    # forked workers start from the same random state, unlike DataLoader workers nothing reseeds them
+    seed = int.from_bytes(os.urandom(4), 'little')
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def _init_render_worker(dataset, collate_fn):
+    _reseed()
+    _render_state['dataset'], _render_state['collate_fn'] = dataset, collate_fn
+
+def _render_shard(epoch, batches, path):
+    dataset = _render_state['dataset']
+    # a private epoch, the shared one still belongs to the epoch being trained on
+    dataset.epoch = torch.full((1,), epoch, dtype=torch.int64)
+    rendered = list(_render(dataset, _render_state['collate_fn'], batches))
+    for i, field in enumerate(FIELDS):
+        save_npy('{}_{}.npy'.format(path, field), torch.cat([torch.as_tensor(b[i]) for b in rendered]).numpy())
+    return path
+
+
+class PrerenderLoader(object):
+    """
+        Renders the next epoch into memory-mapped shards with a process pool
+        while the current one trains, and streams them in the next epoch.
+        Shards that are not ready are rendered on the fly instead.
+    Args:
+        loader: DataLoader over an AugmentedDataset whose epoch is set with set_epoch
+        render_dir: directory to write the shards to
+        num_workers: number of render processes
+        shard_batches: number of batches per shard
+        last_epoch: last epoch to render, None renders one ahead indefinitely
+    """
+    def __init__(self, loader, render_dir, num_workers=4, shard_batches=16, last_epoch=None):
+        self.loader = loader
+        self.last_epoch = last_epoch
+        self.dataset = loader.dataset
+        self.batch_sampler = loader.batch_sampler
+        self.collate_fn = loader.collate_fn or default_collate
+        self.render_dir = render_dir
+        self.shard_batches = shard_batches
+        # shards of each epoch being rendered, as (batches, future) pairs
+        self.rendered = {}
+        self.fallbacks = 0
+
+        os.makedirs(render_dir, exist_ok=True)
+        self.pool = ProcessPoolExecutor(num_workers, initializer=_init_render_worker,
+                                        initargs=(self.dataset, self.collate_fn))
+
+    def epoch_dir(self, epoch):
+        return os.path.join(self.render_dir, 'epoch_{}'.format(epoch))
+
+    def submit(self, epoch):
+        """ start rendering the batches of epoch """
+        sampler = copy.deepcopy(self.batch_sampler)
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+            sampler.start_batch = 0
+        batches = list(sampler)
+
+        os.makedirs(self.epoch_dir(epoch), exist_ok=True)
+        shards = []
+        for k, start in enumerate(range(0, len(batches), self.shard_batches)):
+            shard = batches[start:start + self.shard_batches]
+            path = os.path.join(self.epoch_dir(epoch), 'shard_{}'.format(k))
+            shards.append((shard, self.pool.submit(_render_shard, epoch, shard, path)))
+        self.rendered[epoch] = shards
+
+    def discard(self, epoch):
+        for _, future in self.rendered.pop(epoch, []):
+            future.cancel()
+        shutil.rmtree(self.epoch_dir(epoch), ignore_errors=True)
+
+    def stream(self, shards, start_batch=0):
+        """ the batches of the rendered shards, from start_batch on """
+        first = 0
+        for batches, future in shards:
+            first, skip = first + len(batches), max(start_batch - first, 0)
+            if skip >= len(batches):
+                future.cancel()
+            elif future.done() and future.exception() is None:
+                path = future.result()
+                arrays = [np.load('{}_{}.npy'.format(path, field), mmap_mode='r') for field in FIELDS]
+                offsets = np.cumsum([0] + [len(batch) * self.dataset.num_views for batch in batches])
+                for start, end in zip(offsets[skip:-1], offsets[skip + 1:]):
+                    yield tuple(torch.from_numpy(np.array(a[start:end])) for a in arrays)
+            else:
+                # rendering is behind, do not wait for it
+                future.cancel()
+                self.fallbacks += 1
+                yield from _render(self.dataset, self.collate_fn, batches[skip:])
+
+    def __iter__(self):
+        epoch = int(self.dataset.epoch[0])
+        self.discard(epoch - 1)
+        if epoch + 1 not in self.rendered and (self.last_epoch is None or epoch < self.last_epoch):
+            self.submit(epoch + 1)
+
+        if epoch not in self.rendered:
+            yield from self.loader
+            return
+
+        # resuming mid-epoch, see ResumableBatchSampler.load_state_dict
+        start_batch = getattr(self.batch_sampler, 'start_batch', 0)
+        if start_batch:
+            self.batch_sampler.start_batch = 0
+
+        yield from self.stream(self.rendered[epoch], start_batch)
+        self.discard(epoch)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        for epoch in list(self.rendered):
+            self.discard(epoch)
+
+
+class ThreadLoader(object):
+    """
+        Loader rendering batches on a pool of threads in this process instead
+        of worker processes.
+    Args:
+        loader: DataLoader over an AugmentedDataset, whose dataset, batch_sampler
+            and collate_fn are used (it is never iterated itself)
+        num_threads: number of augmentation threads
+        prefetch: number of batches in flight, defaults to two per thread
+    """
+    def __init__(self, loader, num_threads=4, prefetch=None):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.batch_sampler = loader.batch_sampler
+        self.collate_fn = loader.collate_fn or default_collate
+        self.prefetch = prefetch or 2 * num_threads
+        self.pool = ThreadPoolExecutor(num_threads)
+
+    def render(self, batch):
+        return next(_render(self.dataset, self.collate_fn, [batch]))
+
+    def __iter__(self):
+        batches = iter(self.batch_sampler)
+        pending = deque(self.pool.submit(self.render, batch) for _, batch in zip(range(self.prefetch), batches))
+        try:
+            while pending:
+                rendered = pending.popleft().result()
+                batch = next(batches, None)
+                if batch is not None:
+                    pending.append(self.pool.submit(self.render, batch))
+                yield rendered
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+def _ring_worker(dataset, collate_fn, tasks, ready, free, slots, stalls):
+    _reseed()
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        seq, batch = task
+        try:
+            rendered = next(_render(dataset, collate_fn, [batch]))
+            # batch seq always goes to slot seq % num_slots, once its previous batch is consumed
+            slot = seq % len(free)
+            if not free[slot].acquire(block=False):
+                with stalls.get_lock():
+                    stalls.value += 1
+                free[slot].acquire()
+            n = len(rendered[1])
+            for buffer, tensor in zip(slots, rendered):
+                buffer[slot, :n].copy_(torch.as_tensor(tensor))
+            ready.put((seq, n, None))
+        except Exception:
+            ready.put((seq, 0, traceback.format_exc()))
+
+
+class RingLoader(object):
+    """
+        Loader whose worker processes write batches into a ring of shared-memory
+        slots, yielded without a copy: a batch is only valid until the next one
+        is requested. metrics() reports the queue depth, stalls and slot reuse.
+    Args:
+        loader: DataLoader over an AugmentedDataset, whose dataset, batch_sampler
+            and collate_fn are used (it is never iterated itself)
+        num_workers: number of worker processes
+        num_slots: number of batch slots, defaults to two per worker plus the
+            one held by the training loop
+    """
+    # the yielded tensors are overwritten once the next batch is requested
+    reuses_buffers = True
+
+    def __init__(self, loader, num_workers=4, num_slots=None):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.batch_sampler = loader.batch_sampler
+        self.collate_fn = loader.collate_fn or default_collate
+        self.num_workers = num_workers
+        self.num_slots = num_slots or 2 * num_workers + 1
+
+        # one batch rendered in this process gives the shape and type of the slots
+        np_state = np.random.get_state()
+        with torch.random.fork_rng(devices=[]):
+            probe = next(_render(self.dataset, self.collate_fn, [[0]]))
+        np.random.set_state(np_state)
+        batch_size = self.batch_sampler.batch_size * self.dataset.num_views
+        self.slots = [torch.empty((self.num_slots, batch_size) + tuple(t.shape[1:]), dtype=t.dtype).share_memory_()
+                      for t in map(torch.as_tensor, probe)]
+
+        self.workers = []
+        self.seq = 0
+        self.reset_metrics()
+
+    def start(self):
+        self.tasks, self.ready = mp.Queue(), mp.Queue()
+        self.free = [mp.Semaphore(1) for _ in range(self.num_slots)]
+        self.worker_stalls = mp.Value('l', 0)
+        for _ in range(self.num_workers):
+            w = mp.Process(target=_ring_worker, daemon=True,
+                           args=(self.dataset, self.collate_fn, self.tasks, self.ready, self.free, self.slots,
+                                 self.worker_stalls))
+            w.start()
+            self.workers.append(w)
+
+    def reset_metrics(self):
+        self.batches, self.depth, self.stalls, self.stall_time = 0, 0, 0, 0.0
+        if self.workers:
+            self.worker_stalls.value = 0
+
+    def metrics(self):
+        """ loader metrics since the last reset_metrics """
+        return {
+            'mean_queue_depth': self.depth / max(self.batches, 1),
+            'stalls': self.stalls,
+            'stall_time': self.stall_time,
+            'worker_stalls': self.worker_stalls.value if self.workers else 0,
+            'slot_reuse': self.batches / self.num_slots
+        }
+
+    def receive(self, first, arrived, block):
+        """ move finished batches from the ready queue to arrived, dropping the ones before first """
+        try:
+            seq, n, error = self.ready.get(block=block)
+        except queue.Empty:
+            return False
+        if error is not None:
+            raise RuntimeError('RingLoader worker failed on batch {}:\n{}'.format(seq, error))
+        if seq < first:
+            # left over from an epoch that was not iterated to the end
+            self.free[seq % self.num_slots].release()
+        else:
+            arrived[seq] = n
+        return True
+
+    def __iter__(self):
+        if not self.workers:
+            self.start()
+
+        first = self.seq
+        for batch in self.batch_sampler:
+            self.tasks.put((self.seq, batch))
+            self.seq += 1
+
+        arrived, held = {}, None
+        try:
+            for seq in range(first, self.seq):
+                while self.receive(first, arrived, block=False):
+                    pass
+                if seq not in arrived:
+                    self.stalls += 1
+                    start = time.time()
+                    while seq not in arrived:
+                        self.receive(first, arrived, block=True)
+                    self.stall_time += time.time() - start
+                self.depth += len(arrived)
+                self.batches += 1
+
+                n, slot = arrived.pop(seq), seq % self.num_slots
+                if held is not None:
+                    self.free[held].release()
+                held = slot
+                yield tuple(buffer[slot, :n] for buffer in self.slots)
+        finally:
+            if held is not None:
+                self.free[held].release()
+            for seq in arrived:
+                self.free[seq % self.num_slots].release()
+            self.drain()
+
+    def drain(self):
+        """ drop the tasks that no worker has started yet """
+        while True:
+            try:
+                self.tasks.get_nowait()
+            except queue.Empty:
+                break
+
+    def __len__(self):
+        return len(self.loader)
+
+    def close(self):
+        self.drain()
+        for _ in self.workers:
+            self.tasks.put(None)
+        for w in self.workers:
+            # a worker can still wait for a slot of a batch that was never consumed
+            w.join(timeout=5)
+            if w.is_alive():
+                w.terminate()
+        self.workers = []
+
+
+class DeviceFeeder(object):
+    """
+        Keeps prefetch batches of a loader in flight on a background thread, copied
+        to the device on a side stream on cuda. Other attributes are the loader's.
+    Args:
+        loader: loader yielding tuples of tensors
+        device: device to move the batches to
+        prefetch: number of batches in flight
+    """
+    def __init__(self, loader, device='cuda', prefetch=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.prefetch = prefetch
+        self.cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        # batches of these are only valid until the next one is requested
+        self.copy = getattr(loader, 'reuses_buffers', False)
+
+    def transfer(self, batch):
+        """ batch on the device, and the event its copy is done at on cuda """
+        if not self.cuda:
+            return tuple(t.clone() if self.copy else t for t in batch), None
+
+        if all(t.device.type != 'cpu' for t in batch):
+            # e.g. a TensorLoader holding its split on the device, only the prefetching is left
+            return batch, None
+        # only cpu tensors can be pinned, the others are on the device already
+        batch = tuple(t if t.device.type != 'cpu' or t.is_pinned() else t.pin_memory() for t in batch)
+        with torch.cuda.stream(self.stream):
+            batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+            done = torch.cuda.Event()
+            done.record(self.stream)
+        return batch, done
+
+    @staticmethod
+    def put(batches, stop, item):
+        """ put item in the batches queue unless stop is set first, return whether it was put """
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(self, loaded, batches, stop):
+        try:
+            for batch in loaded:
+                if not self.put(batches, stop, self.transfer(batch)):
+                    return
+            self.put(batches, stop, None)
+        except Exception as e:
+            self.put(batches, stop, e)
+
+    def __iter__(self):
+        loaded = iter(self.loader)
+        batches, stop = queue.Queue(maxsize=self.prefetch), threading.Event()
+        producer = threading.Thread(target=self.produce, args=(loaded, batches, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, done = item
+                if done is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(done)
+                    for t in batch:
+                        # the side stream's allocations are used on the compute stream
+                        t.record_stream(stream)
+                yield batch
+        finally:
+            stop.set()
+            # the wrapped loader cleans up (e.g. RingLoader.drain) now, before it is iterated again
+            producer.join()
+            if hasattr(loaded, 'close'):
+                loaded.close()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+
+class EchoingLoader(object):
+    """
+        Data echoing: augments each raw batch of the loader up to max_echo times
+        with new aug labels, more often the longer the loader keeps the training
+        loop waiting. repeat is the number of earlier uses of the current batch.
+        With a seed, every use is keyed on (seed, epoch, batch, repeat).
+    Args:
+        loader: loader yielding (images, true_labels, aug_labels) with raw uint8 images
+        batch_aug: augment.BatchAugment applying the tf combinations
+        max_echo: most times a batch is used
+        momentum: smoothing of the measured wait and compute times
+    """
+    def __init__(self, loader, batch_aug, max_echo=4, momentum=0.9):
+        self.loader = loader
+        self.batch_aug = batch_aug
+        self.max_echo = max_echo
+        self.momentum = momentum
+        self.factor = 1
+        self.wait, self.compute = 0.0, 0.0
+        self.echoed = 0
+        self.repeat = 0
+
+    def average(self, mean, value):
+        return self.momentum * mean + (1 - self.momentum) * value
+
+    def reseed(self, batch, echo):
+        """ seed the transformations of use echo of the epoch's batch, return the generator of its labels """
+        dataset, sampler = self.loader.dataset, self.loader.batch_sampler
+        if dataset.seed is None:
+            seed_transform_generator(None)
+            return None
+        # distinct across the ranks, which share the seed
+        idx = batch * getattr(sampler, 'num_replicas', 1) + getattr(sampler, 'rank', 0)
+        rng = keyed_rng(dataset.seed, int(dataset.epoch[0]), idx, stream=echo + 1)
+        seed_transform_generator(int(rng.integers(2 ** 63)))
+        return rng
+
+    def echo_labels(self, aug_labels, rng):
+        """ new aug labels for the samples of a batch with aug_labels, drawn from rng """
+        dataset, labels = self.loader.dataset, aug_labels.cpu().numpy()
+        if getattr(self.loader.batch_sampler, 'balanced', False):
+            # the batch's own labels shuffled, so the epoch stays balanced
+            labels = (rng or np.random).permutation(labels)
+        else:
+            labels = dataset.draw_aug_labels(len(labels) // dataset.num_views, rng).reshape(-1)
+        return torch.as_tensor(labels, device=aug_labels.device)
+
+    def __iter__(self):
+        # resuming mid-epoch, see ResumableBatchSampler.load_state_dict
+        first = getattr(self.loader.batch_sampler, 'start_batch', 0)
+        grouped = isinstance(self.loader.batch_sampler, AugLabelBatchSampler)
+        batches = iter(self.loader)
+        for batch in itertools.count(first):
+            start = time.time()
+            loaded = next(batches, None)
+            if loaded is None:
+                return
+            self.wait = self.average(self.wait, time.time() - start)
+
+            images, true_labels, aug_labels = loaded
+            for echo in range(self.factor):
+                rng = self.reseed(batch, echo)
+                if echo > 0:
+                    aug_labels = self.echo_labels(aug_labels, rng)
+                    if grouped:
+                        # as AugLabelBatchSampler orders its batches
+                        order = torch.as_tensor(np.argsort(aug_labels.cpu().numpy(), kind='stable'))
+                        images, true_labels, aug_labels = (t[order.to(t.device)] for t in (images, true_labels, aug_labels))
+                    self.echoed += 1
+                augmented = self.batch_aug(images, aug_labels)
+                self.repeat = echo
+                start = time.time()
+                yield augmented, true_labels, aug_labels
+                self.compute = self.average(self.compute, time.time() - start)
+
+            if self.wait > self.compute:
+                self.factor = min(self.factor + 1, self.max_echo)
+            elif self.wait < 0.1 * self.compute:
+                self.factor = max(self.factor - 1, 1)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
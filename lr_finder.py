@@ -3,7 +3,6 @@ import argparse
 import glob
 import os
 
-import cv2
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -47,18 +46,31 @@ if __name__ == '__main__':
     parser.add_argument('-base_lr', type=float, default=1e-7, help='min learning rate')
     parser.add_argument('-max_lr', type=float, default=10, help='max learning rate')
     parser.add_argument('-num_iter', type=int, default=100, help='num of iteration')
-    parser.add_argument('-gpu', type=bool, default=True, help='use gpu or not')
+    parser.add_argument('-gpu', action='store_true', default=False, help='use gpu or not')
     parser.add_argument('-gpus', nargs='+', type=int, default=0, help='gpu device')
+    parser.add_argument('-data', type=str, default='/data/scratch/swhan/data/', help='path to data directory')
+    parser.add_argument('-dataset', type=str, default='cifar100', help='name of dataset (cifar10, cifar100 or synthetic)')
+    parser.add_argument('-synthetic_size', type=int, default=50000, help='number of training images of the synthetic dataset')
+    parser.add_argument('-synthetic_test_size', type=int, default=10000, help='number of test images of the synthetic dataset')
+    parser.add_argument('-synthetic_classes', type=int, default=100, help='number of classes of the synthetic dataset')
+    parser.add_argument('-tfs',  nargs='+', default=[], help='transformations to predict, as in train.py')
+    parser.add_argument('-max_num_tf_combos', type=int, default=-1, help='as in train.py')
     args = parser.parse_args()
 
+    if args.dataset == 'synthetic':
+        configure_synthetic(args.synthetic_size, args.synthetic_test_size, args.synthetic_classes)
+    device = torch.device('cuda' if args.gpu else 'cpu')
+
+    all_tf_combs = get_all_tf_combs(None, None, args.tfs, args.max_num_tf_combos, dataset=args.dataset, data_dir=args.data)
     cifar100_training_loader = get_training_dataloader(
-        settings.CIFAR100_TRAIN_MEAN,
-        settings.CIFAR100_TRAIN_STD,
+        args.data,
+        all_tf_combs,
         num_workers=4,
         batch_size=args.b,
+        dataset=args.dataset
     )
 
-    net = get_network(args)
+    net = get_network(args, num_classes=len(all_tf_combs), online_num_classes=dataset_num_classes[args.dataset])
 
     loss_function = nn.CrossEntropyLoss()
     optimizer = optim.SGD(net.parameters(), lr=args.base_lr, momentum=0.9, weight_decay=1e-4, nesterov=True)
@@ -76,18 +88,19 @@ if __name__ == '__main__':
         #training procedure
         net.train()
 
-        for batch_index, (images, labels) in enumerate(cifar100_training_loader):
+        for batch_index, (images, true_labels, aug_labels) in enumerate(cifar100_training_loader):
             if n > args.num_iter:
                 break
 
             lr_scheduler.step()
 
-            images = images.cuda()
-            labels = labels.cuda()
+            images = images.to(device)
+            true_labels = true_labels.to(device)
+            aug_labels = aug_labels.to(device)
 
             optimizer.zero_grad()
-            predicts = net(images)
-            loss = loss_function(predicts, labels)
+            predicts, predicts_online = net(images)
+            loss = loss_function(predicts, aug_labels) + loss_function(predicts_online, true_labels)
             if torch.isnan(loss).any():
                 n += 1e8
                 break
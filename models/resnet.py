@@ -136,7 +136,9 @@ class ResNet(nn.Module):
         if extract_features:
             return output
 
-        output_online = self.online_fc(output.detach())
+        # the linear probe stays in fp32 under autocast, its inputs are detached anyway
+        with torch.autocast(output.device.type, enabled=False):
+            output_online = self.online_fc(output.detach().float())
         output = self.fc(output)
 
         return output, output_online
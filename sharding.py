@@ -0,0 +1,132 @@
+""" ZeRO-style sharding of the training state across ranks, checkpointed unsharded
+
+author seungwook
+"""
+import torch
+import torch.distributed as dist
+from torch.distributed.fsdp import fully_shard, FSDPModule
+from torch.distributed.tensor import DTensor
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from torch.distributed.checkpoint.state_dict import StateDictOptions, get_model_state_dict, \
+    get_optimizer_state_dict, set_model_state_dict, set_optimizer_state_dict
+
+# none is plain DDP, optimizer ZeRO-1 (ZeroRedundancyOptimizer), gradients ZeRO-2 and full ZeRO-3 (fully_shard)
+shard_modes = ['none', 'optimizer', 'gradients', 'full']
+# modes sharding the parameters themselves, which are DTensors then
+param_shard_modes = ['gradients', 'full']
+
+
+def _broadcast(tensors, src=0):
+    """ tensors of rank src on every rank, one broadcast per dtype """
+    for dtype in {t.dtype for t in tensors}:
+        group = [t for t in tensors if t.dtype == dtype]
+        flat = torch.cat([t.detach().flatten() for t in group])
+        dist.broadcast(flat, src)
+        offset = 0
+        for t in group:
+            t.detach().copy_(flat[offset:offset + t.numel()].view_as(t))
+            offset += t.numel()
+
+def broadcast_buffers(model, src=0):
+    """ the buffers of model of rank src on every rank, a collective: call it on every rank """
+    buffers = list(model.buffers())
+    if buffers:
+        _broadcast(buffers, src)
+
+def _broadcast_buffers_hook(module, args):
+    # what DDP's broadcast_buffers does, only the forwards that train update the buffers
+    if module.training and torch.is_grad_enabled():
+        broadcast_buffers(module)
+
+def _shard_tree(module, min_num_params, **kwargs):
+    """ fully_shard the submodules of module holding at least min_num_params parameters
+    that no smaller submodule shards, leaves first, return how many are left over """
+    num_params = sum(p.numel() for p in module.parameters(recurse=False))
+    for child in module.children():
+        num_params += _shard_tree(child, min_num_params, **kwargs)
+    if num_params >= min_num_params:
+        fully_shard(module, **kwargs)
+        return 0
+    return num_params
+
+def shard_model(model, mode, min_num_params=int(1e6)):
+    """ shard the parameters of model in place across the ranks, starting from rank 0's
+    parameters and buffers and broadcasting its buffers before every training forward, as DDP does
+    Args:
+        model: network to shard, still called as before
+        mode: 'gradients' or 'full' (see shard_modes)
+        min_num_params: smallest number of parameters gathered at once, every
+            submodule holding that many is gathered on its own in forward and backward
+    Returns: model
+    """
+    # every rank starts from rank 0's model, as DDP does
+    _broadcast(list(model.parameters()) + list(model.buffers()))
+    model.register_forward_pre_hook(_broadcast_buffers_hook)
+
+    reshard = mode == 'full'
+    _shard_tree(model, min_num_params, reshard_after_forward=reshard)
+    if not isinstance(model, FSDPModule):
+        # the parameters left over
+        fully_shard(model, reshard_after_forward=reshard)
+    return model
+
+def sharded_optimizer(optimizer_class, params, mode, **kwargs):
+    """ optimizer_class(params, **kwargs), holding only the state of this rank's share of
+    params with mode 'optimizer', the parameters are sharded already in the other modes """
+    if mode == 'optimizer':
+        return ZeroRedundancyOptimizer(params, optimizer_class=optimizer_class, **kwargs)
+    return optimizer_class(params, **kwargs)
+
+def full_tensor(tensor):
+    """ tensor gathered from the ranks if it is sharded, a collective then: call it on every rank """
+    if isinstance(tensor, DTensor):
+        return tensor.full_tensor()
+    return tensor
+
+def full_model_state_dict(model, mode):
+    """ state dict of the unsharded model, on rank 0: call it on every rank """
+    if mode in param_shard_modes:
+        # the buffers of rank 0, as under DDP
+        broadcast_buffers(model)
+        return get_model_state_dict(model, options=StateDictOptions(full_state_dict=True, cpu_offload=True))
+    return model.state_dict()
+
+def full_optimizer_state_dict(model, optimizer, mode):
+    """ state dict of the unsharded optimizer, on rank 0: call it on every rank """
+    if mode in param_shard_modes:
+        return get_optimizer_state_dict(model, optimizer, options=StateDictOptions(full_state_dict=True, cpu_offload=True))
+    if mode == 'optimizer':
+        optimizer.consolidate_state_dict(to=0)
+        if dist.get_rank() != 0:
+            return None
+    return optimizer.state_dict()
+
+def load_full_model_state_dict(model, state, mode):
+    """ load a state dict of the unsharded model, on every rank """
+    if mode in param_shard_modes:
+        set_model_state_dict(model, state, options=StateDictOptions(full_state_dict=True))
+    else:
+        model.load_state_dict(state)
+
+def load_full_optimizer_state_dict(model, optimizer, state, mode):
+    """ load a state dict of the unsharded optimizer, on every rank """
+    if mode in param_shard_modes:
+        set_optimizer_state_dict(model, optimizer, state, options=StateDictOptions(full_state_dict=True))
+    else:
+        optimizer.load_state_dict(state)
+
+def _local_bytes(tensor):
+    if isinstance(tensor, DTensor):
+        tensor = tensor.to_local()
+    return tensor.numel() * tensor.element_size()
+
+def local_state_bytes(model, optimizer):
+    """ bytes of the parameters, gradients and optimizer state this rank holds, as a dict """
+    params = [p for p in model.parameters()]
+    # ZeroRedundancyOptimizer keeps the state of this rank's share in its local optimizer
+    state = getattr(optimizer, 'optim', optimizer).state
+    return {
+        'parameters': sum(_local_bytes(p) for p in params),
+        'gradients': sum(_local_bytes(p.grad) for p in params if p.grad is not None),
+        'optimizer': sum(_local_bytes(t) for s in state.values() for t in s.values() if torch.is_tensor(t))
+    }
@@ -17,7 +17,7 @@ import torchvision.transforms as transforms
 from torch.utils.data import DataLoader
 
 from conf import settings
-from utils import get_network, get_test_dataloader
+from utils import get_network, get_test_dataloader, get_all_tf_combs, dataset_num_classes, configure_synthetic
 
 if __name__ == '__main__':
 
@@ -26,39 +26,58 @@ if __name__ == '__main__':
     parser.add_argument('-weights', type=str, required=True, help='the weights file you want to test')
     parser.add_argument('-gpu', action='store_true', default=False, help='use gpu or not')
     parser.add_argument('-b', type=int, default=16, help='batch size for dataloader')
+    parser.add_argument('-data', type=str, default='/data/scratch/swhan/data/', help='path to data directory')
+    parser.add_argument('-dataset', type=str, default='cifar100', help='name of dataset (cifar10, cifar100 or synthetic)')
+    parser.add_argument('-synthetic_size', type=int, default=50000, help='number of training images of the synthetic dataset')
+    parser.add_argument('-synthetic_test_size', type=int, default=10000, help='number of test images of the synthetic dataset')
+    parser.add_argument('-synthetic_classes', type=int, default=100, help='number of classes of the synthetic dataset')
+    parser.add_argument('-tfs',  nargs='+', default=[], help='transformations the network was trained with')
+    parser.add_argument('-max_num_tf_combos', type=int, default=-1, help='as in train.py')
+    parser.add_argument('-num_tf_labels', type=int, default=None, help='as in train.py')
     args = parser.parse_args()
 
-    net = get_network(args)
+    if args.dataset == 'synthetic':
+        configure_synthetic(args.synthetic_size, args.synthetic_test_size, args.synthetic_classes)
+    device = torch.device('cuda' if args.gpu else 'cpu')
+
+    all_tf_combs = get_all_tf_combs(None, None, args.tfs, args.max_num_tf_combos, num_labels=args.num_tf_labels,
+                                    dataset=args.dataset, data_dir=args.data)
+    net = get_network(args, num_classes=len(all_tf_combs), online_num_classes=dataset_num_classes[args.dataset])
 
     cifar100_test_loader = get_test_dataloader(
-        settings.CIFAR100_TRAIN_MEAN,
-        settings.CIFAR100_TRAIN_STD,
-        #settings.CIFAR100_PATH,
+        args.data,
+        all_tf_combs,
         num_workers=4,
         batch_size=args.b,
+        dataset=args.dataset
     )
 
-    net.load_state_dict(torch.load(args.weights))
+    net.load_state_dict(torch.load(args.weights, map_location=device))
     print(net)
     net.eval()
 
     correct_1 = 0.0
     correct_5 = 0.0
+    correct_aug = 0.0
     total = 0
 
     with torch.no_grad():
-        for n_iter, (image, label) in enumerate(cifar100_test_loader):
+        for n_iter, (image, label, aug_label) in enumerate(cifar100_test_loader):
             print("iteration: {}\ttotal {} iterations".format(n_iter + 1, len(cifar100_test_loader)))
 
             if args.gpu:
                 image = image.cuda()
                 label = label.cuda()
+                aug_label = aug_label.cuda()
                 print('GPU INFO.....')
                 print(torch.cuda.memory_summary(), end='')
 
 
-            output = net(image)
-            _, pred = output.topk(5, 1, largest=True, sorted=True)
+            output, output_online = net(image)
+            correct_aug += output.argmax(1).eq(aug_label).sum()
+
+            # top 5 of the online classifier, or of all its classes if there are fewer
+            _, pred = output_online.topk(min(5, output_online.size(1)), 1, largest=True, sorted=True)
 
             label = label.view(label.size(0), -1).expand_as(pred)
             correct = pred.eq(label).float()
@@ -76,4 +95,5 @@ if __name__ == '__main__':
     print()
     print("Top 1 err: ", 1 - correct_1 / len(cifar100_test_loader.dataset))
     print("Top 5 err: ", 1 - correct_5 / len(cifar100_test_loader.dataset))
+    print("Aug label err: ", 1 - correct_aug / len(cifar100_test_loader.dataset))
     print("Parameter numbers: {}".format(sum(p.numel() for p in net.parameters())))
@@ -17,6 +17,8 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import torchvision
 import torchvision.transforms as transforms
 
@@ -26,103 +28,210 @@ from torch.utils.tensorboard import SummaryWriter
 from conf import settings
 from utils import get_network, get_training_dataloader, get_test_dataloader, WarmUpLR, \
     most_recent_folder, most_recent_weights, last_epoch, best_acc_weights, get_all_tf_combs, dataset_num_classes, \
-    knn_monitor
-
-def train(epoch):
+    knn_monitor, get_memory_usage, FrozenTestLoader, pool_views, \
+    configure_synthetic, autocast, grad_scaler, MetricAccumulator
+from dataset import SharedDatasetStore, atomic_write
+from augment import BatchAugment
+from autotune import autotune, cache_key, load_tuned, save_tuned, model_step_time, available_cpus, train_threads
+from distributed import init_distributed, is_main_process, all_reduce_sum, broadcast_object, silence_other_ranks, \
+    cleanup, NullWriter
+from comm_hooks import comm_hooks, register_comm_hook
+from sharding import shard_modes, param_shard_modes, shard_model, sharded_optimizer, full_tensor, full_model_state_dict, \
+    full_optimizer_state_dict, load_full_model_state_dict, load_full_optimizer_state_dict, local_state_bytes, \
+    broadcast_buffers
+
+def train(epoch, start_batch=0):
+    global global_step
 
     start = time.time()
     net.train()
-    for batch_index, (images, true_labels, aug_labels) in enumerate(cifar100_training_loader):
-
-        if args.gpu:
-            true_labels = true_labels.cuda()
-            aug_labels = aug_labels.cuda()
-            images = images.cuda()
+    # losses and gradient norms stay on the device between flushes
+    metrics = MetricAccumulator(writer, args.flush_metrics_every)
+    # index of the batch of the sampler, which --echo uses for several steps
+    sampler_batch = start_batch - 1
+    for batch_index, (images, true_labels, aug_labels) in enumerate(cifar100_training_loader, start_batch):
+        new_batch = not args.echo or cifar100_training_loader.repeat == 0
+        if new_batch:
+            sampler_batch += 1
+
+        # no-ops for batches the loader already put on the device
+        true_labels = true_labels.to(device, non_blocking=True)
+        aug_labels = aug_labels.to(device, non_blocking=True)
+        images = images.to(device, non_blocking=True)
 
         optimizer.zero_grad()
-        outputs, outputs_online = net(images)
-        loss = loss_function(outputs, aug_labels)
-        loss_online = loss_function(outputs_online, true_labels)
-        loss_total = loss + loss_online
-        loss_total.backward()
-        optimizer.step()
-
-        n_iter = (epoch - 1) * len(cifar100_training_loader) + batch_index + 1
-
-        last_layer = list(net.children())[-1]
-        for name, para in last_layer.named_parameters():
-            if 'weight' in name:
-                writer.add_scalar('LastLayerGradients/grad_norm2_weights', para.grad.norm(), n_iter)
-            if 'bias' in name:
-                writer.add_scalar('LastLayerGradients/grad_norm2_bias', para.grad.norm(), n_iter)
+        with autocast(device, args.amp):
+            outputs, outputs_online = net(images)
+            loss = loss_function(outputs, aug_labels)
+            loss_online = loss_function(outputs_online, true_labels)
+            loss_total = loss + loss_online
+        scaler.scale(loss_total).backward()
+        # the gradient norms are logged below, unscaled
+        scaler.unscale_(optimizer)
+        scaler.step(optimizer)
+        scaler.update()
+
+        # steps, not batches of the sampler, so that echoed steps do not overlap the next epoch
+        global_step += 1
+        n_iter = global_step
+
+        if comm_state is not None:
+            # backward waited for every bucket, so the step's communication is complete
+            step_bytes, step_time = comm_state.stats.step()
+            writer.add_scalar('Comm/bytes_per_step', step_bytes, n_iter)
+            writer.add_scalar('Comm/time_per_step', step_time, n_iter)
+
+        for tag, para in last_layer_params:
+            metrics.add(tag, full_tensor(para.grad.norm()), n_iter)
 
 
         if batch_index % 100 == 0:
+            loss_value, loss_online_value = metrics.to_host([loss, loss_online])
             print('Training Epoch: {epoch} [{trained_samples}/{total_samples}]\tLoss: {:0.4f}\tLoss Online Clf: {:0.4f}\tLR: {:0.6f}'.format(
-                loss.item(),
-                loss_online.item(),
+                loss_value.item(),
+                loss_online_value.item(),
                 optimizer.param_groups[0]['lr'],
                 epoch=epoch,
-                trained_samples=batch_index * args.batch_size + len(images),
-                total_samples=len(cifar100_training_loader.dataset)
+                trained_samples=sampler_batch * args.batch_size * args.num_views + len(images),
+                total_samples=len(cifar100_training_loader.dataset) * args.num_views
             ))
 
         #update training loss for each iteration
-        writer.add_scalar('Train/loss', loss.item(), n_iter)
+        metrics.add('Train/loss', loss, n_iter)
+        metrics.step()
 
-        if epoch <= args.warm:
+        # warmup is sized in batches of the sampler
+        if epoch <= args.warm and new_batch:
             warmup_scheduler.step()
 
-    for name, param in net.named_parameters():
+        if args.ckpt_iters and (batch_index + 1) % args.ckpt_iters == 0:
+            # the logs reach up to the resumed batch
+            metrics.flush()
+            save_resume_state(batch_index + 1)
+
+    metrics.flush()
+    print('epoch {} metrics synced to the host {} times in {} steps'.format(epoch, metrics.syncs, metrics.steps))
+    writer.add_scalar('Train/metric_syncs', metrics.syncs, epoch)
+
+    for name, param in model.named_parameters():
         layer, attr = os.path.splitext(name)
         attr = attr[1:]
-        writer.add_histogram("{}/{}".format(layer, attr), param, epoch)
+        writer.add_histogram("{}/{}".format(layer, attr), full_tensor(param), epoch)
+
+    if args.loader == 'ring':
+        for name, value in cifar100_training_loader.metrics().items():
+            writer.add_scalar('Loader/{}'.format(name), value, epoch)
+        cifar100_training_loader.reset_metrics()
+    if args.echo:
+        writer.add_scalar('Loader/echo_factor', cifar100_training_loader.factor, epoch)
+        writer.add_scalar('Loader/echoed_batches', cifar100_training_loader.echoed, epoch)
+    if comm_state is not None and comm_state.stats.steps:
+        stats = comm_state.stats
+        print('epoch {} communication ({}): {:.3f} MB and {:.4f}s per step'.format(
+            epoch, args.comm_hook, stats.bytes / stats.steps / 2**20, stats.time / stats.steps))
+        stats.reset()
+    if args.shard != 'none':
+        state_bytes = local_state_bytes(model, optimizer)
+        print('epoch {} state of rank 0 ({} sharded): {}'.format(epoch, args.shard, ', '.join(
+            '{:.1f} MB {}'.format(nbytes / 2**20, name) for name, nbytes in state_bytes.items())))
+        for name, nbytes in state_bytes.items():
+            writer.add_scalar('Memory/{}_MB'.format(name), nbytes / 2**20, epoch)
 
     finish = time.time()
 
     print('epoch {} training time consumed: {:.2f}s'.format(epoch, finish - start))
 
+def save_resume_state(batches_done):
+    """ save everything needed to resume training right after batches_done batches of this epoch """
+    # sharded states are consolidated on rank 0 by every rank
+    net_state = full_model_state_dict(model, args.shard)
+    optimizer_state = full_optimizer_state_dict(model, optimizer, args.shard)
+    if not is_main_process():
+        return
+    state = {
+        'net': net_state,
+        'optimizer': optimizer_state,
+        'train_scheduler': train_scheduler.state_dict(),
+        'warmup_scheduler': warmup_scheduler.state_dict(),
+        'scaler': scaler.state_dict(),
+        'sampler': cifar100_training_loader.batch_sampler.state_dict(batches_done),
+        'best_acc': best_acc,
+        'seed': args.seed
+    }
+    # a preempted save never corrupts the last state
+    with atomic_write(resume_path, 'wb') as f:
+        torch.save(state, f)
+
 @torch.no_grad()
 def eval_training(epoch=0, tb=True, num_aug_classes=0):
 
     start = time.time()
-    net.eval()
-
-    test_loss = 0.0 # cost function error
-    test_loss_online = 0.0
-    correct = 0.0
-    correct_online = 0.0
-    correct_per_class = torch.zeros(num_aug_classes, device='cuda')
-    total_per_class = torch.zeros(num_aug_classes, device='cuda')
+    model.eval()
+    if args.shard in param_shard_modes:
+        # every rank evaluates with the BN running stats of rank 0, the ones checkpointed
+        broadcast_buffers(model)
+
+    # running sums of the losses (cost function error) and of the correct predictions, on the device
+    sum_tags = ['loss', 'loss_online', 'correct', 'correct_online']
+    if args.num_views > 1:
+        sum_tags += ['correct_all_views', 'correct_online_pooled']
+    metrics = MetricAccumulator(device=device, sum_tags=sum_tags)
+    correct_per_class = torch.zeros(num_aug_classes, device=device)
+    total_per_class = torch.zeros(num_aug_classes, device=device)
 
     for (images, true_labels, aug_labels) in cifar100_test_loader:
 
-        if args.gpu:
-            true_labels = true_labels.cuda()
-            aug_labels = aug_labels.cuda()
-            images = images.cuda()
+        true_labels = true_labels.to(device, non_blocking=True)
+        aug_labels = aug_labels.to(device, non_blocking=True)
+        images = images.to(device, non_blocking=True)
 
-        outputs, outputs_online = net(images)
-        loss = loss_function(outputs, aug_labels)
-        loss_online = loss_function(outputs_online, true_labels)
+        # the unwrapped network, ranks may see different numbers of test batches
+        with autocast(device, args.amp):
+            outputs, outputs_online = model(images)
+            loss = loss_function(outputs, aug_labels)
+            loss_online = loss_function(outputs_online, true_labels)
 
-        test_loss += loss.item()
+        # weighted by the batch size, so the average is per sample whatever the batching (e.g. --frozen-test)
+        metrics.sum('loss', loss * len(aug_labels))
         _, preds = outputs.max(1)
-        correct += preds.eq(aug_labels).sum()
+        metrics.sum('correct', preds.eq(aug_labels).sum())
 
-        test_loss_online += loss_online.item()
+        metrics.sum('loss_online', loss_online * len(true_labels))
         _, preds_online = outputs_online.max(1)
-        correct_online += preds_online.eq(true_labels).sum()
+        metrics.sum('correct_online', preds_online.eq(true_labels).sum())
 
         # mean per class accuracy
         correct_vec = (preds == aug_labels) # if each prediction is correct or not
-        ind_per_class = (aug_labels.unsqueeze(1) == torch.arange(num_aug_classes, device='cuda')) # indicator variable for each class
+        ind_per_class = (aug_labels.unsqueeze(1) == torch.arange(num_aug_classes, device=device)) # indicator variable for each class
         correct_per_class += (correct_vec.unsqueeze(1) * ind_per_class).sum(0)
         total_per_class += ind_per_class.sum(0)
 
-    # sanity check that the sum of total per class amounts to the whole dataset
-    assert total_per_class.sum() == len(cifar100_test_loader.dataset)
+        # the views of each image scored together
+        if args.num_views > 1:
+            metrics.sum('correct_all_views', correct_vec.view(-1, args.num_views).all(1).sum())
+            _, preds_pooled = pool_views(outputs_online, args.num_views).max(1)
+            metrics.sum('correct_online_pooled', preds_pooled.eq(true_labels[::args.num_views]).sum())
+
+    # summed over the ranks, then moved to the host together
+    sums = metrics.reduce_sums()
+    test_loss, test_loss_online = sums['loss'], sums['loss_online']
+    correct, correct_online = sums['correct'], sums['correct_online']
+    all_reduce_sum(correct_per_class)
+    all_reduce_sum(total_per_class)
     acc_per_class = correct_per_class / total_per_class
+    acc_per_class, mean_acc_per_class, num_counted = metrics.to_host(
+        [acc_per_class, acc_per_class.mean(), total_per_class.sum()])
+
+    # sanity check that the sum of total per class amounts to the whole dataset
+    # with views, the frozen test set already holds every view as a sample
+    num_samples = len(cifar100_test_loader.dataset)
+    if not args.frozen_test:
+        num_samples *= args.num_views
+    if world_size > 1:
+        # the distributed samplers pad the set to a multiple of the world size
+        num_samples = int(num_counted)
+    assert num_counted == num_samples
+    num_images = num_samples // args.num_views
 
     finish = time.time()
     if args.gpu:
@@ -132,27 +241,36 @@ def eval_training(epoch=0, tb=True, num_aug_classes=0):
     print('Evaluating Network.....')
     print('Test set: Epoch: {}, Average loss: {:.4f}, Accuracy: {:.4f}, Mean per-class accuracy: {:.4f}, Average online clf loss: {:.4f}, Online clf accuracy: {:.4f}, Time consumed:{:.2f}s'.format(
         epoch,
-        test_loss / len(cifar100_test_loader.dataset),
-        correct.float() / len(cifar100_test_loader.dataset),
-        acc_per_class.mean().float(),
-        test_loss_online / len(cifar100_test_loader.dataset),
-        correct_online.float() / len(cifar100_test_loader.dataset),
+        test_loss / num_samples,
+        correct / num_samples,
+        mean_acc_per_class.item(),
+        test_loss_online / num_samples,
+        correct_online / num_samples,
         finish - start
     ))
+    if args.num_views > 1:
+        print('All {} views correct: {:.4f}, Online clf accuracy of pooled views: {:.4f}'.format(
+            args.num_views,
+            sums['correct_all_views'] / num_images,
+            sums['correct_online_pooled'] / num_images
+        ))
     print()
 
     #add informations to tensorboard
     if tb:
-        writer.add_scalar('Test/Average loss', test_loss / len(cifar100_test_loader.dataset), epoch)
-        writer.add_scalar('Test/Accuracy', correct.float() / len(cifar100_test_loader.dataset), epoch)
-        writer.add_scalar('Test/Mean per class accuracy', acc_per_class.mean().float(), epoch)
-        writer.add_scalar('Test/Average online clf loss', test_loss_online / len(cifar100_test_loader.dataset), epoch)
-        writer.add_scalar('Test/Accuracy online clf', correct_online.float() / len(cifar100_test_loader.dataset), epoch)
+        writer.add_scalar('Test/Average loss', test_loss / num_samples, epoch)
+        writer.add_scalar('Test/Accuracy', correct / num_samples, epoch)
+        writer.add_scalar('Test/Mean per class accuracy', mean_acc_per_class.item(), epoch)
+        writer.add_scalar('Test/Average online clf loss', test_loss_online / num_samples, epoch)
+        writer.add_scalar('Test/Accuracy online clf', correct_online / num_samples, epoch)
+        if args.num_views > 1:
+            writer.add_scalar('Test/Accuracy all views', sums['correct_all_views'] / num_images, epoch)
+            writer.add_scalar('Test/Accuracy online clf pooled views', sums['correct_online_pooled'] / num_images, epoch)
 
         for c in range(num_aug_classes):
-            writer.add_scalar(f'Test/Class {c} ({str(all_tf_combs[c])}) accuracy', acc_per_class[c].float(), epoch)
+            writer.add_scalar(f'Test/Class {c} ({str(all_tf_combs[c])}) accuracy', acc_per_class[c].item(), epoch)
 
-    return correct.float() / len(cifar100_test_loader.dataset)
+    return correct / num_samples
 
 def make_sh_and_submit(args, delay=0):
     os.makedirs('./scripts/submit_scripts/', exist_ok=True)
@@ -198,15 +316,44 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--net', type=str, required=True, help='net type')
     parser.add_argument('--data', type=str, default='/data/scratch/swhan/data/', help='path to data directory')
-    parser.add_argument('--dataset', type=str, default='cifar100', help='name of dataset')
+    parser.add_argument('--dataset', type=str, default='cifar100', help='name of dataset (cifar10, cifar100 or synthetic)')
+    parser.add_argument('--synthetic-size', type=int, default=50000, help='number of training images of the synthetic dataset')
+    parser.add_argument('--synthetic-test-size', type=int, default=10000, help='number of test images of the synthetic dataset')
+    parser.add_argument('--synthetic-classes', type=int, default=100, help='number of classes of the synthetic dataset')
     parser.add_argument('--gpu', action='store_true', default=False, help='use gpu or not')
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'fp16', 'bf16'], help='mixed precision of the forward passes')
     parser.add_argument('--batch-size', type=int, default=128, help='batch size for dataloader')
     parser.add_argument('--warm', type=int, default=1, help='warm up training phase')
     parser.add_argument('--lr', type=float, default=0.1, help='initial learning rate')
     parser.add_argument('--resume', action='store_true', default=False, help='resume training')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the sample order, aug labels and transformations, makes epochs reproducible')
+    parser.add_argument('--ckpt-iters', type=int, default=0, help='save the mid-epoch resume state every this many iterations (0 is never)')
     parser.add_argument('--online-clf', action='store_true', default=False, help='monitor online classifier test accuracy')
     parser.add_argument('--tfs',  nargs='+', default=[], help='Choose from [crop, hflip, vflip, rotate, invert, blur, solarize, grayscale, colorjitter, halfswap')
     parser.add_argument('--max-num-tf-combos', type=int, default=-1, help='Maximum number of augmentation combination per class (-1 is all)')
+    parser.add_argument('--num-tf-labels', type=int, default=None, help='sample this many tf combinations as classes instead of using all of them')
+    parser.add_argument('--cache', action='store_true', default=False, help='memory-map the pre-decoded dataset cache (built on first use)')
+    parser.add_argument('--frozen-test', action='store_true', default=False, help='render the augmented test set once and keep it on the device')
+    parser.add_argument('--frozen-test-batch-size', type=int, default=1000, help='batch size for evaluating the frozen test set')
+    parser.add_argument('--aug-sampler', type=str, default='random', choices=['random', 'uniform', 'balanced'], help='draw aug labels per sample, or assign them per epoch and group batches by them')
+    parser.add_argument('--aug-backend', type=str, default='pil', choices=['pil', 'tensor', 'batch'], help='augment per sample on PIL images or uint8 tensors, or per batch')
+    parser.add_argument('--render-dir', type=str, default=None, help='pre-render the next epoch into this directory (--loader workers only)')
+    parser.add_argument('--loader', type=str, default='workers', choices=['workers', 'ring', 'threads', 'memory'], help='loader backend of the training loader (see utils.get_training_dataloader)')
+    parser.add_argument('--prefetch', type=int, default=2, help='batches in flight on the device (0 is off)')
+    parser.add_argument('--num-workers', type=int, default=4, help='worker processes or threads per loader')
+    parser.add_argument('--prefetch-factor', type=int, default=2, help='batches in flight per worker')
+    parser.add_argument('--autotune', action='store_true', default=False, help='pick --loader, --num-workers and --prefetch-factor by timing them')
+    parser.add_argument('--intra-op-threads', type=int, default=None, help='torch intra-op threads of the training process')
+    parser.add_argument('--echo', type=int, default=0, help='most uses of each training batch while waiting for data (0 is off)')
+    parser.add_argument('--num-views', type=int, default=1, help='views with distinct aug labels per image')
+    parser.add_argument('--flush-metrics-every', type=int, default=50, help='steps between logging the training metrics (0 is once per epoch)')
+    parser.add_argument('--dist-backend', type=str, default=None, choices=['gloo', 'nccl'], help='process group backend (default nccl with --gpu, gloo otherwise)')
+    parser.add_argument('--comm-hook', type=str, default='none', choices=['none'] + list(comm_hooks), help='gradient communication hook of DDP (see comm_hooks)')
+    parser.add_argument('--powersgd-rank', type=int, default=2, help='rank of the PowerSGD approximation of each gradient matrix')
+    parser.add_argument('--topk-ratio', type=float, default=0.01, help='fraction of the gradient entries top-k sends each step')
+    parser.add_argument('--shard', type=str, default='none', choices=shard_modes, help='ZeRO-style sharding of the training state across ranks (see sharding)')
+    parser.add_argument('--bucket-cap-mb', type=int, default=25, help='size of the gradient buckets all-reduced together by DDP')
+    parser.add_argument('--eval-loader', type=str, default=None, choices=['workers', 'ring', 'threads', 'memory'], help='loader backend of the test and kNN loaders (defaults to --loader)')
 
     # kNN args
     parser.add_argument('--knn-monitor', action='store_true', default=False, help='monitor knn test accuracy')
@@ -221,90 +368,275 @@ if __name__ == '__main__':
         make_sh_and_submit(args)
         sys.exit(0)
 
-    all_tf_combs = get_all_tf_combs(settings.CIFAR100_TRAIN_MEAN, settings.CIFAR100_TRAIN_STD, args.tfs, args.max_num_tf_combos)
-    test_tf = get_all_tf_combs(settings.CIFAR100_TRAIN_MEAN, settings.CIFAR100_TRAIN_STD, [], 0)
+    if args.num_views > 1 and args.aug_sampler != 'random':
+        parser.error('--aug-sampler assigns a single aug label per image, use --aug-sampler random with --num-views')
+    if args.echo and args.ckpt_iters:
+        parser.error('--ckpt-iters counts batches of the sampler, which --echo repeats')
+
+    if args.dataset == 'synthetic':
+        configure_synthetic(args.synthetic_size, args.synthetic_test_size, args.synthetic_classes)
+
+    # one process per rank under torchrun or srun
+    rank, world_size, local_rank = init_distributed(gpu=args.gpu, backend=args.dist_backend)
+    silence_other_ranks()
+    if world_size > 1 and args.echo:
+        parser.error('--echo adapts the number of steps per rank, which DDP needs to be equal')
+    if args.shard != 'none' and world_size == 1:
+        parser.error('--shard splits the training state across ranks, launch with torchrun or srun')
+    if args.shard in param_shard_modes and args.comm_hook != 'none':
+        parser.error('--comm-hook replaces the all-reduce of DDP, which --shard {} does not use'.format(args.shard))
+    if args.shard in param_shard_modes and args.frozen_test:
+        parser.error('--frozen-test gives the ranks unequal numbers of test batches, whose sharded forwards must match')
+
+    # the ranks write to (and resume from) the checkpoint folder named by rank 0
+    settings.TIME_NOW = broadcast_object(settings.TIME_NOW)
+    if args.resume:
+        recent_folder = most_recent_folder(os.path.join(settings.CHECKPOINT_PATH, args.net), fmt=settings.DATE_FORMAT)
+        if not recent_folder:
+            raise Exception('no recent folder were found')
+
+        checkpoint_path = os.path.join(settings.CHECKPOINT_PATH, args.net, recent_folder)
+
+    else:
+        checkpoint_path = os.path.join(settings.CHECKPOINT_PATH, args.net, settings.TIME_NOW)
+    resume_path = os.path.join(checkpoint_path, 'resume.pth')
+
+    state = None
+    if args.resume and os.path.exists(resume_path):
+        print('loading mid-epoch state {} to resume training.....'.format(resume_path))
+        state = torch.load(resume_path, map_location='cpu')
+        # every loader, the test ones too, draws from the seed of the run being resumed
+        args.seed = state.get('seed', state['sampler']['seed'])
+
+    # resuming mid-epoch and rendering ahead need the keyed sample order and aug labels,
+    # so do the ranks to agree on them
+    if (args.ckpt_iters or args.resume or args.render_dir or world_size > 1) and args.seed is None:
+        args.seed = np.random.randint(2 ** 31)
+    args.seed = broadcast_object(args.seed)
+
+    # the tensor and batch backends keep images uint8 until the batch is on the device
+    uint8 = args.aug_backend != 'pil'
+    all_tf_combs = get_all_tf_combs(None, None, args.tfs, args.max_num_tf_combos, num_labels=args.num_tf_labels,
+                                    tensor=uint8, dataset=args.dataset, data_dir=args.data)
+    test_tf = get_all_tf_combs(all_tf_combs.mean, all_tf_combs.std, [], 0, tensor=uint8)
+
+    batch_aug, test_batch_aug = None, None
+    if args.aug_backend == 'batch':
+        batch_aug = BatchAugment(all_tf_combs, normalize=False)
+        test_batch_aug = BatchAugment(test_tf, normalize=False)
+    device = torch.device('cuda', local_rank) if args.gpu else torch.device('cpu')
+
+    aug_sampler = args.aug_sampler if args.aug_sampler != 'random' else None
+
+    # decode the dataset once, all loaders (and their workers) are views over it
+    store = SharedDatasetStore(args.data, args.dataset, cache=args.cache)
+
+    print(f'Initializing {args.net} with {len(all_tf_combs)} number of augmented classes')
+    net = get_network(args, num_classes=len(all_tf_combs), online_num_classes=dataset_num_classes[args.dataset])
+
+    if args.autotune and args.intra_op_threads is None:
+        # torch defaults to every physical core, leaving no budget for the loader
+        args.intra_op_threads = train_threads(device, available_cpus())
+    if args.intra_op_threads:
+        torch.set_num_threads(args.intra_op_threads)
+
+    if args.autotune:
+        key = cache_key(args.tfs, args.aug_backend, args.batch_size)
+        tuned = load_tuned(settings.AUTOTUNE_CACHE, key)
+        # only worker processes pre-render, and in memory the batches are augmented by the training
+        # process, which only keeps up with the same tfs on the gpu
+        backends = ('workers', 'threads', 'ring')
+        if args.render_dir:
+            backends = ('workers',)
+        elif args.gpu and args.aug_backend == 'batch':
+            backends += ('memory',)
+        if tuned is None or tuned['loader'] not in backends:
+            # keep up with the model step, with some headroom
+            required = 1.1 * args.batch_size / model_step_time(net, args.batch_size, device, amp=args.amp)
+            tuned = autotune(lambda backend, num_workers, prefetch_factor: get_training_dataloader(
+                args.data, all_tf_combs, num_workers=num_workers, batch_size=args.batch_size, batch_aug=batch_aug,
+                store=store, uint8=uint8, device=device, backend=backend, prefetch_factor=prefetch_factor), required,
+                backends=backends)
+            save_tuned(settings.AUTOTUNE_CACHE, key, tuned)
+        print('Autotuned loader: {loader} with {num_workers} workers, prefetch factor {prefetch_factor} '
+              '({images_per_sec:.0f} images/s)'.format(**tuned))
+        args.loader, args.num_workers, args.prefetch_factor = tuned['loader'], tuned['num_workers'], tuned['prefetch_factor']
+    # after autotuning, which may have replaced --loader
+    if args.echo and args.aug_backend != 'batch' and args.loader != 'memory':
+        parser.error('--echo augments whole batches, use --aug-backend batch, or --loader memory without --autotune')
+    if args.num_workers < 1 and {args.loader, args.eval_loader} & {'ring', 'threads'}:
+        parser.error('--loader ring and threads need --num-workers 1 or more')
+    if args.render_dir and args.loader != 'workers':
+        parser.error('--render-dir pre-renders with DataLoader workers, use --loader workers')
+
+    # model is checkpointed, evaluated and inspected, net is what trains, the two differ with DDP
+    model = net
+    if args.shard in param_shard_modes:
+        # sharded in place, model and net stay the same module
+        print(f'Training on {world_size} ranks with the {dist.get_backend()} backend, {args.shard} sharded')
+        shard_model(model, args.shard)
+    elif world_size > 1:
+        print(f'Training on {world_size} ranks with the {dist.get_backend()} backend')
+        net = DistributedDataParallel(model, device_ids=[local_rank] if args.gpu else None,
+                                      bucket_cap_mb=args.bucket_cap_mb)
+    comm_state = None
+    if world_size > 1 and args.comm_hook != 'none':
+        hook_args = {'powersgd': {'rank': args.powersgd_rank, 'seed': args.seed}, 'topk': {'ratio': args.topk_ratio}}
+        comm_state = register_comm_hook(net, args.comm_hook, **hook_args.get(args.comm_hook, {}))
+
+    # the parameters of the last layer, whose gradient norms are logged every step
+    last_layer_params = []
+    for name, para in list(model.children())[-1].named_parameters():
+        if 'weight' in name:
+            last_layer_params.append(('LastLayerGradients/grad_norm2_weights', para))
+        if 'bias' in name:
+            last_layer_params.append(('LastLayerGradients/grad_norm2_bias', para))
 
     #data preprocessing:
     cifar100_training_loader = get_training_dataloader(
         args.data,
         all_tf_combs,
-        num_workers=4,
+        num_workers=args.num_workers,
         batch_size=args.batch_size,
-        shuffle=True
+        shuffle=True,
+        batch_aug=batch_aug,
+        store=store,
+        aug_sampler=aug_sampler,
+        seed=args.seed,
+        uint8=uint8,
+        device=device,
+        pin_memory=args.gpu,
+        persistent_workers=True,
+        prefetch=args.prefetch,
+        prefetch_factor=args.prefetch_factor,
+        backend=args.loader,
+        render_dir=args.render_dir,
+        last_epoch=settings.EPOCH,
+        echo=args.echo,
+        num_views=args.num_views
     )
 
     # train loader used as memory bank for knn monitor (only default transformations)
     cifar100_memory_loader = get_training_dataloader(
         args.data,
         test_tf,
-        num_workers=4,
+        num_workers=args.num_workers,
         batch_size=args.batch_size,
-        shuffle=False
+        shuffle=False,
+        batch_aug=test_batch_aug,
+        store=store,
+        uint8=uint8,
+        device=device,
+        pin_memory=args.gpu,
+        persistent_workers=True,
+        prefetch=args.prefetch,
+        prefetch_factor=args.prefetch_factor,
+        backend=args.eval_loader or args.loader
     )
 
     cifar100_test_loader = get_test_dataloader(
         args.data,
         all_tf_combs,
-        num_workers=4,
+        num_workers=args.num_workers,
         batch_size=args.batch_size,
         shuffle=True,
+        batch_aug=batch_aug,
+        store=store,
+        aug_sampler=aug_sampler,
+        seed=args.seed,
+        uint8=uint8,
+        device=device,
+        pin_memory=args.gpu,
+        persistent_workers=True,
+        prefetch=args.prefetch,
+        prefetch_factor=args.prefetch_factor,
+        backend=args.eval_loader or args.loader,
+        num_views=args.num_views
     )
 
     # test loader used as memory bank for knn monitor (only default transformations)
     cifar100_default_test_loader = get_test_dataloader(
         args.data,
         test_tf,
-        num_workers=4,
+        num_workers=args.num_workers,
         batch_size=args.batch_size,
         shuffle=False,
+        batch_aug=test_batch_aug,
+        store=store,
+        uint8=uint8,
+        device=device,
+        pin_memory=args.gpu,
+        persistent_workers=True,
+        prefetch=args.prefetch,
+        prefetch_factor=args.prefetch_factor,
+        backend=args.eval_loader or args.loader,
+        # sharded across the ranks, the memory bank above is not
+        seed=args.seed if world_size > 1 else None
     )
 
-    print(f'Initializing {args.net} with {len(all_tf_combs)} number of augmented classes')
-    net = get_network(args, num_classes=len(all_tf_combs), online_num_classes=dataset_num_classes[args.dataset])
+    if args.frozen_test:
+        cifar100_test_loader = FrozenTestLoader(
+            cifar100_test_loader,
+            batch_size=args.frozen_test_batch_size,
+            device=device
+        )
+
+    resident, shared = get_memory_usage()
+    print(f'Resident memory: {resident:.1f} MB ({shared:.1f} MB shared), dataset store: {store.nbytes() / 2 ** 20:.1f} MB')
 
     loss_function = nn.CrossEntropyLoss()
-    optimizer = optim.SGD(net.parameters(), lr=args.lr, momentum=0.9, weight_decay=5e-4)
+    optimizer = sharded_optimizer(optim.SGD, net.parameters(), args.shard, lr=args.lr, momentum=0.9, weight_decay=5e-4)
     train_scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones=settings.MILESTONES, gamma=0.2) #learning rate decay
     iter_per_epoch = len(cifar100_training_loader)
     warmup_scheduler = WarmUpLR(optimizer, iter_per_epoch * args.warm)
-
-    if args.resume:
-        recent_folder = most_recent_folder(os.path.join(settings.CHECKPOINT_PATH, args.net), fmt=settings.DATE_FORMAT)
-        if not recent_folder:
-            raise Exception('no recent folder were found')
-
-        checkpoint_path = os.path.join(settings.CHECKPOINT_PATH, args.net, recent_folder)
-
-    else:
-        checkpoint_path = os.path.join(settings.CHECKPOINT_PATH, args.net, settings.TIME_NOW)
+    scaler = grad_scaler(device, args.amp, sharded=args.shard in param_shard_modes)
 
     #use tensorboard
-    if not os.path.exists(settings.LOG_DIR):
+    if not os.path.exists(settings.LOG_DIR) and is_main_process():
         os.mkdir(settings.LOG_DIR)
 
     #since tensorboard can't overwrite old values
     #so the only way is to create a new tensorboard log
-    writer = SummaryWriter(log_dir=os.path.join(
-            settings.LOG_DIR, args.net, settings.TIME_NOW))
+    #only rank 0 logs
+    writer = NullWriter()
+    if is_main_process():
+        writer = SummaryWriter(log_dir=os.path.join(
+                settings.LOG_DIR, args.net, settings.TIME_NOW))
     input_tensor = torch.Tensor(1, 3, 32, 32)
     if args.gpu:
         input_tensor = input_tensor.cuda()
-    writer.add_graph(net, input_tensor)
+    # tracing runs on rank 0 alone, a sharded forward needs every rank
+    if args.shard not in param_shard_modes:
+        writer.add_graph(model, input_tensor)
     writer.add_text('Transformations', str(all_tf_combs))
 
     #create checkpoint folder to save model
-    if not os.path.exists(checkpoint_path):
+    if not os.path.exists(checkpoint_path) and is_main_process():
         os.makedirs(checkpoint_path)
     checkpoint_path = os.path.join(checkpoint_path, '{net}-{epoch}-{type}.pth')
 
     best_acc = 0.0
-    if args.resume:
+    resume_batch = 0
+    if state is not None:
+        load_full_model_state_dict(model, state['net'], args.shard)
+        load_full_optimizer_state_dict(model, optimizer, state['optimizer'], args.shard)
+        train_scheduler.load_state_dict(state['train_scheduler'])
+        warmup_scheduler.load_state_dict(state['warmup_scheduler'])
+        if 'scaler' in state:
+            scaler.load_state_dict(state['scaler'])
+        cifar100_training_loader.batch_sampler.load_state_dict(state['sampler'])
+        best_acc = state['best_acc']
+
+        resume_epoch = state['sampler']['epoch'] - 1
+        resume_batch = state['sampler']['batches_done']
+
+    elif args.resume:
         best_weights = best_acc_weights(os.path.join(settings.CHECKPOINT_PATH, args.net, recent_folder))
         if best_weights:
             weights_path = os.path.join(settings.CHECKPOINT_PATH, args.net, recent_folder, best_weights)
             print('found best acc weights file:{}'.format(weights_path))
             print('load best training file to test acc...')
-            net.load_state_dict(torch.load(weights_path))
+            load_full_model_state_dict(model, torch.load(weights_path, map_location=device), args.shard)
             best_acc = eval_training(tb=False)
             print('best acc is {:0.2f}'.format(best_acc))
 
@@ -313,10 +645,12 @@ if __name__ == '__main__':
             raise Exception('no recent weights file were found')
         weights_path = os.path.join(settings.CHECKPOINT_PATH, args.net, recent_folder, recent_weights_file)
         print('loading weights file {} to resume training.....'.format(weights_path))
-        net.load_state_dict(torch.load(weights_path))
+        load_full_model_state_dict(model, torch.load(weights_path, map_location=device), args.shard)
 
         resume_epoch = last_epoch(os.path.join(settings.CHECKPOINT_PATH, args.net, recent_folder))
 
+    # training steps logged so far, one per batch of the epochs before the resumed one without --echo
+    global_step = resume_epoch * iter_per_epoch + resume_batch if args.resume else 0
 
     for epoch in range(1, settings.EPOCH + 1):
         if epoch > args.warm:
@@ -326,23 +660,40 @@ if __name__ == '__main__':
             if epoch <= resume_epoch:
                 continue
 
-        train(epoch)
+        if args.seed is not None or aug_sampler:
+            cifar100_training_loader.batch_sampler.set_epoch(epoch)
+            cifar100_training_loader.dataset.set_epoch(epoch)
+            if not args.frozen_test:
+                cifar100_test_loader.batch_sampler.set_epoch(epoch)
+                cifar100_test_loader.dataset.set_epoch(epoch)
+
+        train(epoch, start_batch=resume_batch)
+        resume_batch = 0
         acc = eval_training(epoch, num_aug_classes=len(all_tf_combs))
 
         if (epoch % args.knn_int) == 1:
-            knn_acc = knn_monitor(net, cifar100_memory_loader, cifar100_default_test_loader, 'cuda', k=200, writer=writer, epoch=epoch)
+            knn_acc = knn_monitor(model, cifar100_memory_loader, cifar100_default_test_loader, device, k=200, writer=writer, epoch=epoch,
+                                  amp=args.amp)
 
         #start to save best performance model after learning rate decay to 0.01
         if epoch > settings.MILESTONES[1] and best_acc < acc:
             weights_path = checkpoint_path.format(net=args.net, epoch=epoch, type='best')
             print('saving weights file to {}'.format(weights_path))
-            torch.save(net.state_dict(), weights_path)
+            weights = full_model_state_dict(model, args.shard)
+            if is_main_process():
+                torch.save(weights, weights_path)
             best_acc = acc
             continue
 
         if not epoch % settings.SAVE_EPOCH:
             weights_path = checkpoint_path.format(net=args.net, epoch=epoch, type='regular')
             print('saving weights file to {}'.format(weights_path))
-            torch.save(net.state_dict(), weights_path)
+            weights = full_model_state_dict(model, args.shard)
+            if is_main_process():
+                torch.save(weights, weights_path)
 
+    for loader in [cifar100_training_loader, cifar100_memory_loader, cifar100_test_loader, cifar100_default_test_loader]:
+        if hasattr(loader, 'close'):
+            loader.close()
     writer.close()
+    cleanup()
@@ -6,30 +6,76 @@ import os
 import sys
 import re
 import datetime
+import functools
+import math
 import random
+import resource
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy
 
 import torch
 from torch.optim.lr_scheduler import _LRScheduler
+from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
 import torchvision
 import torchvision.transforms as transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, TensorDataset
 from itertools import combinations
 from PIL import ImageOps
 
-from dataset import AugmentedDataset
+from conf import settings
+from dataset import AugmentedDataset, AugLabelBatchSampler, ResumableBatchSampler, dataset_names, synthetic_config, \
+    transform_generator, load_json, update_json
+from augment import BatchAugment, collate_raw
+from distributed import all_reduce_sum, get_rank, get_world_size
+from loader import TensorLoader, PrerenderLoader, RingLoader, ThreadLoader, DeviceFeeder, EchoingLoader
+
+# data of a stats worker, set once when the worker starts
+_stats_state = {}
 
 feature_dims = {
     'renset18': 512,
     'resnet50': 2048
 }
 
+# statistics of the datasets that are not computed (see get_mean_std)
+dataset_mean_std = {
+    'cifar100': (settings.CIFAR100_TRAIN_MEAN, settings.CIFAR100_TRAIN_STD)
+}
+
 dataset_num_classes = {
+    'cifar10': 10,
     'cifar100': 100,
+    'synthetic': synthetic_config['num_classes']
+}
+
+
+# autocast dtype of each --amp mode
+amp_dtypes = {
+    'off': None,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16
 }
 
+def autocast(device, amp='off'):
+    """ autocast context of an amp mode ('off', 'fp16' or 'bf16') on device """
+    return torch.autocast(torch.device(device).type, dtype=amp_dtypes[amp], enabled=amp != 'off')
+
+def grad_scaler(device, amp='off', sharded=False):
+    """ GradScaler of an amp mode, only enabled for fp16, whose small gradients underflow,
+    a ShardedGradScaler agreeing on overflows across ranks when the gradients are sharded """
+    if sharded:
+        return ShardedGradScaler(torch.device(device).type, enabled=amp == 'fp16')
+    return torch.amp.GradScaler(torch.device(device).type, enabled=amp == 'fp16')
+
+def configure_synthetic(train_size=None, test_size=None, num_classes=None):
+    """ set the sizes and the number of classes of the synthetic dataset (see dataset.SyntheticDataset),
+    the ones left None keep their value
+    """
+    config = {'train_size': train_size, 'test_size': test_size, 'num_classes': num_classes}
+    synthetic_config.update({k: v for k, v in config.items() if v is not None})
+    dataset_num_classes['synthetic'] = synthetic_config['num_classes']
 
 def get_network(args, num_classes=100, online_num_classes=100):
     """ return given network
@@ -177,85 +223,324 @@ def get_network(args, num_classes=100, online_num_classes=100):
 
     return net
 
-class Solarization(object):
+class Transform(object):
+    """ repr as the torchvision transforms, e.g. for the tensorboard tags of the tf combinations """
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join('{}={}'.format(k, v) for k, v in vars(self).items()))
+
+class Solarization(Transform):
     def __init__(self, p):
         self.p = p
 
     def __call__(self, img):
-        if random.random() < self.p:
-            return ImageOps.solarize(img)
-        else:
+        if torch.rand(1, generator=transform_generator()).item() >= self.p:
             return img
+        if isinstance(img, torch.Tensor):
+            # uint8 tensor, same threshold as ImageOps.solarize
+            return transforms.functional.solarize(img, 128)
+        return ImageOps.solarize(img)
 
-def get_all_tf_combs(mean, std, tfs, max_num_comb=-1):
-    """ return all possible tf combinations
+# the random transformations below are the torchvision ones of the same name, but draw their
+# parameters from dataset.transform_generator instead of torch's global random state
+
+class RandomCrop(Transform):
+    def __init__(self, size, padding):
+        self.size = size
+        self.padding = padding
+
+    def __call__(self, img):
+        img = transforms.functional.pad(img, self.padding)
+        _, h, w = transforms.functional.get_dimensions(img)
+        generator = transform_generator()
+        i = torch.randint(0, h - self.size + 1, (1,), generator=generator).item()
+        j = torch.randint(0, w - self.size + 1, (1,), generator=generator).item()
+        return transforms.functional.crop(img, i, j, self.size, self.size)
+
+class RandomRotation(Transform):
+    def __init__(self, degrees):
+        self.degrees = degrees
+
+    def __call__(self, img):
+        angle = torch.empty(1).uniform_(-self.degrees, self.degrees, generator=transform_generator()).item()
+        return transforms.functional.rotate(img, angle)
+
+class GaussianBlur(Transform):
+    def __init__(self, kernel_size, sigma):
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+
+    def __call__(self, img):
+        sigma = torch.empty(1).uniform_(*self.sigma, generator=transform_generator()).item()
+        return transforms.functional.gaussian_blur(img, [self.kernel_size] * 2, [sigma, sigma])
+
+class ColorJitter(Transform):
+    def __init__(self, brightness, contrast, saturation, hue):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+
+    def __call__(self, img):
+        generator = transform_generator()
+        order = torch.randperm(4, generator=generator).tolist()
+        ranges = [(1 - self.brightness, 1 + self.brightness), (1 - self.contrast, 1 + self.contrast),
+                  (1 - self.saturation, 1 + self.saturation), (-self.hue, self.hue)]
+        factors = [torch.empty(1).uniform_(*r, generator=generator).item() for r in ranges]
+        adjust = [transforms.functional.adjust_brightness, transforms.functional.adjust_contrast,
+                  transforms.functional.adjust_saturation, transforms.functional.adjust_hue]
+        for i in order:
+            img = adjust[i](img, factors[i])
+        return img
+
+class Apply(Transform):
+    """ a deterministic function of transforms.functional, a picklable transforms.Lambda """
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, img):
+        return self.fn(img)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.fn.__name__)
+
+# flexible transformations, in the order they are applied within a combination
+tf_factories = {
+    'crop': lambda: RandomCrop(32, padding=4),
+    'hflip': lambda: Apply(transforms.functional.hflip),
+    'vflip': lambda: Apply(transforms.functional.vflip),
+    'rotate': lambda: RandomRotation(90),
+    'invert': lambda: Apply(transforms.functional.invert),
+    'blur': lambda: GaussianBlur(3, sigma=(0.1, 2.0)),
+    'solarize': lambda: Solarization(1.0),
+    'grayscale': lambda: transforms.Grayscale(3),
+    'colorjitter': lambda: ColorJitter(brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1)
+}
+
+# TODO: halfswap (but this needs to work in the tensor space not PIL Image)
+
+class TfCombinationSpace(object):
+    """
+        Space of tf combinations, indexed like the list of transforms.Compose it
+        replaces. Every aug label maps to a bitmask over self.tfs (bit i set if
+        the i-th tf is applied) and back in O(1), and the Compose of a label is
+        only built when it is first used. Only the tf names and the masks are
+        pickled into the DataLoader workers. With tensor, the Compose works on
+        uint8 tensors and leaves out ToTensor and Normalize, which then run once
+        per batch (see NormalizedLoader).
     Args:
         mean: mean of training dataset
         std: std of training dataset
-    Returns: all possible combinations of transformations that defines each class
+        tfs: names of the flexible transformations to combine
+        max_num_comb: maximum number of tfs per combination (-1 is all)
+        num_labels: sample this many distinct combinations instead of
+            enumerating all of them, for vocabularies too large to enumerate
+        seed: seed of the sampled combinations
+        tensor: build the Compose for uint8 tensors instead of PIL images
+    """
+    max_cached = 1024
+
+    def __init__(self, mean, std, tfs, max_num_comb=-1, num_labels=None, seed=0, tensor=False):
+        self.mean = tuple(mean)
+        self.std = tuple(std)
+        self.tensor = tensor
+        self.tfs = [t for t in tf_factories if t in tfs]
+        if max_num_comb == -1:
+            max_num_comb = len(self.tfs)
+
+        if num_labels is None:
+            # all 0-n combinations, in the order of itertools.combinations
+            subsets = [c for i in range(max_num_comb + 1) for c in combinations(range(len(self.tfs)), i)]
+        else:
+            subsets = self._sample_subsets(len(self.tfs), max_num_comb, num_labels, seed)
+        masks = [sum(1 << i for i in c) for c in subsets]
+        self.masks = numpy.array(masks, dtype=numpy.int64 if len(self.tfs) < 63 else object)
+
+        self._labels = None
+        self._cache = {}
+
+    @staticmethod
+    def _sample_subsets(n, max_num_comb, num_labels, seed):
+        """ draw distinct subsets uniformly from all subsets of at most max_num_comb tfs,
+        returned in the same order as they would be enumerated """
+        sizes = numpy.array([math.comb(n, k) for k in range(max_num_comb + 1)], dtype=float)
+        if num_labels > sizes.sum():
+            raise ValueError('cannot sample {} distinct combinations out of {}'.format(num_labels, int(sizes.sum())))
+
+        rng = numpy.random.default_rng(seed)
+        subsets = set()
+        while len(subsets) < num_labels:
+            k = rng.choice(len(sizes), p=sizes / sizes.sum())
+            subsets.add(tuple(sorted(rng.choice(n, k, replace=False).tolist())))
+
+        return sorted(subsets, key=lambda c: (len(c), c))
+
+    def __len__(self):
+        return len(self.masks)
+
+    def mask(self, label):
+        """ bitmask of the tfs applied by an aug label """
+        return int(self.masks[label])
+
+    def label(self, mask):
+        """ aug label of a bitmask of tfs """
+        if self._labels is None:
+            self._labels = {int(m): l for l, m in enumerate(self.masks)}
+        return self._labels[mask]
+
+    def names(self, label):
+        """ names of the tfs applied by an aug label """
+        mask = self.mask(label)
+        return tuple(t for i, t in enumerate(self.tfs) if mask >> i & 1)
+
+    def __getitem__(self, label):
+        mask = self.mask(label)
+        if mask not in self._cache:
+            if len(self._cache) >= self.max_cached:
+                self._cache.pop(next(iter(self._cache)))
+            tfs = [tf_factories[t]() for t in self.names(label)]
+            if not self.tensor:
+                tfs += [transforms.ToTensor(), transforms.Normalize(self.mean, self.std)]
+            self._cache[mask] = transforms.Compose(tfs)
+
+        return self._cache[mask]
+
+    def __iter__(self):
+        for label in range(len(self)):
+            yield self[label]
+
+    def __repr__(self):
+        return '[{}]'.format(', '.join(repr(self[label]) for label in range(len(self))))
+
+    def __getstate__(self):
+        # workers rebuild the label lookup and the Compose objects on demand
+        state = self.__dict__.copy()
+        state['_labels'] = None
+        state['_cache'] = {}
+        return state
+
+def get_all_tf_combs(mean, std, tfs, max_num_comb=-1, num_labels=None, tensor=False, dataset=None, data_dir=None):
+    """ return all possible tf combinations
+    Args:
+        mean: mean of training dataset, None to take it from get_mean_std
+        std: std of training dataset, None to take it from get_mean_std
+        tfs: names of the flexible transformations
+        max_num_comb: maximum number of transformations per combination (-1 is all)
+        num_labels: only keep this many randomly sampled combinations
+        tensor: combine transformations of uint8 tensors, without ToTensor and Normalize
+        dataset: name of the dataset whose mean and std to use when they are None
+        data_dir: path to data directory, to compute them if they are not cached
+    Returns: all possible combinations of transformations that defines each class,
+        as a TfCombinationSpace of transforms.Compose
     """
+    if mean is None or std is None:
+        mean, std = get_mean_std(data_dir, dataset)
 
-    flexible_tf = []
-
-    if 'crop' in tfs:
-        flexible_tf.append(transforms.RandomCrop(32, padding=4))
-    if 'hflip' in tfs:
-        flexible_tf.append(transforms.RandomHorizontalFlip(p=1.0))
-    if 'vflip' in tfs:
-        flexible_tf.append(transforms.RandomVerticalFlip(p=1.0))
-    if 'rotate' in tfs:
-        flexible_tf.append(transforms.RandomRotation(90))
-    if 'invert' in tfs:
-        flexible_tf.append(transforms.RandomInvert(p=1.0))
-    if 'blur' in tfs:
-        flexible_tf.append(transforms.GaussianBlur(3, sigma=(0.1, 2.0)))
-    if 'solarize' in tfs:
-        flexible_tf.append(Solarization(1.0))
-    if 'grayscale' in tfs:
-        flexible_tf.append(transforms.Grayscale(3))
-    if 'colorjitter' in tfs:
-        flexible_tf.append(transforms.ColorJitter(brightness=0.4, contrast=0.4,
-                                            saturation=0.2, hue=0.1))
-
-    # TODO: halfswap (but this needs to work in the tensor space not PIL Image)
-
-    # flexible_tf = [
-    #     transforms.RandomCrop(32, padding=4),
-    #     transforms.RandomHorizontalFlip(p=1.0),
-    #     transforms.RandomVerticalFlip(p=1.0),
-    #     transforms.RandomRotation(90),
-    #     transforms.RandomInvert(p=1.0),
-    #     transforms.GaussianBlur(3, sigma=(0.1, 2.0))
-    #     ]
-    default_tf = [
-        transforms.ToTensor(),
-        transforms.Normalize(mean, std)
-        ]
-    
-    # getting all possible 1-n combinations of transformations
-    all_tf_combs = []
-    if max_num_comb == -1:
-        max_num_comb = len(flexible_tf)
-    
-    for i in range(max_num_comb+1):
-        combs = list(combinations(flexible_tf, i))
-        all_tf_combs += combs
-    
-    # adding in default transformations
-    for j in range(len(all_tf_combs)):
-        all_tf_combs[j] = transforms.Compose(all_tf_combs[j] + tuple(default_tf))
+    return TfCombinationSpace(mean, std, tfs, max_num_comb, num_labels=num_labels, tensor=tensor)
 
-    return all_tf_combs
 
-    
-def get_training_dataloader(data_dir, all_tfs, batch_size=16, num_workers=2, shuffle=True):
+def get_batch_sampler(num_samples, num_aug, batch_size, shuffle=True, aug_sampler=None, seed=None):
+    """ return the batch sampler of a loader, or None for the DataLoader's default one
+    Args:
+        num_samples: size of the dataset
+        num_aug: number of tf combinations
+        batch_size: dataloader batchsize
+        shuffle: whether to shuffle
+        aug_sampler: None, 'uniform' or 'balanced' (see dataset.AugLabelBatchSampler)
+        seed: base seed of a resumable sample order (see dataset.ResumableBatchSampler)
+    """
+    if aug_sampler:
+        return AugLabelBatchSampler(num_samples, num_aug, batch_size, shuffle=shuffle,
+                                    balanced=aug_sampler == 'balanced', seed=seed)
+    if seed is not None:
+        return ResumableBatchSampler(num_samples, batch_size, shuffle=shuffle, seed=seed)
+
+    return None
+
+def get_loader(dataset, all_tfs, batch_size, num_workers, shuffle, batch_aug, aug_sampler, seed, uint8, device, backend,
+               render_dir=None, pin_memory=False, persistent_workers=False, prefetch=0, prefetch_factor=2, echo=0,
+               last_epoch=None):
+    """ return the loader over an AugmentedDataset, see get_training_dataloader for the arguments """
+    if aug_sampler and dataset.num_views > 1:
+        raise ValueError('aug_sampler assigns a single aug label per sample, it cannot be used with num_views')
+    if backend in ('ring', 'threads') and num_workers < 1:
+        # the ring would wait forever on slots no worker fills, the thread pool needs a thread
+        raise ValueError('the {} loader needs num_workers >= 1, got {}'.format(backend, num_workers))
+    if render_dir and backend != 'workers':
+        raise ValueError('render_dir pre-renders with DataLoader workers, it cannot be used with the {} loader'.format(backend))
+
+    collate_fn = batch_aug.collate if batch_aug else None
+    if echo:
+        if batch_aug is None:
+            raise ValueError('data echoing needs batch_aug to augment the batches it repeats')
+        # batches stay raw until EchoingLoader augments them
+        collate_fn = collate_raw
+
+    batch_sampler = get_batch_sampler(len(dataset), len(all_tfs), batch_size, shuffle, aug_sampler, seed)
+    # pre-rendering only iterates the DataLoader for epochs that were not rendered, e.g. the first
+    persistent_workers = persistent_workers and not render_dir
+    if backend == 'memory':
+        loader = TensorLoader(dataset, None if echo else batch_aug, batch_size=batch_size, shuffle=shuffle,
+                              batch_sampler=batch_sampler, device=device)
+    elif batch_sampler:
+        loader = DataLoader(
+            dataset, batch_sampler=batch_sampler, num_workers=num_workers,
+            collate_fn=collate_fn, pin_memory=pin_memory,
+            persistent_workers=persistent_workers and num_workers > 0,
+            prefetch_factor=prefetch_factor if num_workers > 0 else None)
+    else:
+        loader = DataLoader(
+            dataset, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+            collate_fn=collate_fn, pin_memory=pin_memory,
+            persistent_workers=persistent_workers and num_workers > 0,
+            prefetch_factor=prefetch_factor if num_workers > 0 else None)
+
+    if backend == 'ring':
+        loader = RingLoader(loader, num_workers=num_workers, num_slots=prefetch_factor * num_workers + 1)
+    elif backend == 'threads':
+        loader = ThreadLoader(loader, num_threads=num_workers, prefetch=prefetch_factor * num_workers)
+    elif render_dir:
+        loader = PrerenderLoader(loader, render_dir, num_workers=num_workers, last_epoch=last_epoch)
+
+    # the ring's workers load out of process already, on the cpu the feeder would only copy its slots
+    if prefetch and not (backend == 'ring' and torch.device(device or 'cpu').type == 'cpu'):
+        loader = DeviceFeeder(loader, device or 'cpu', prefetch=prefetch)
+
+    if echo:
+        loader = EchoingLoader(loader, batch_aug, max_echo=echo)
+
+    if uint8:
+        loader = NormalizedLoader(loader, all_tfs.mean, all_tfs.std, device=device)
+
+    return loader
+
+def get_training_dataloader(data_dir, all_tfs, batch_size=16, num_workers=2, shuffle=True, batch_aug=None, cache=False,
+                            store=None, aug_sampler=None, seed=None, uint8=False, device=None, backend='workers',
+                            render_dir=None, pin_memory=False, persistent_workers=False, prefetch=0, prefetch_factor=2,
+                            echo=0, num_views=1, dataset='cifar100', last_epoch=None):
     """ return training dataloader
     Args:
         data_dir: path to data directory
         all_tfs: list of transformation combinations
         batch_size: dataloader batchsize
-        num_workers: dataloader num_works
+        num_workers: dataloader num_works, or the processes or threads of backend
         shuffle: whether to shuffle
+        batch_aug: augment.BatchAugment to apply all_tfs per batch instead of per sample
+        cache: memory-map the pre-decoded dataset cache (see dataset.build_cache)
+        store: dataset.SharedDatasetStore to take the split from
+        aug_sampler: 'uniform' or 'balanced' (see dataset.AugLabelBatchSampler)
+        seed: seed of the sample order, aug labels and transformations
+        uint8: keep the images uint8 and normalize every batch (see NormalizedLoader)
+        device: device of the batches, or of the split with backend 'memory'
+        backend: 'workers' (DataLoader), 'ring', 'threads' or 'memory' (see loader)
+        pin_memory: pin_memory of the DataLoader
+        persistent_workers: persistent_workers of the DataLoader
+        prefetch: batches in flight on device (see loader.DeviceFeeder)
+        prefetch_factor: batches in flight per worker
+        render_dir: pre-render the next epoch into this directory (see loader.PrerenderLoader)
+        last_epoch: last epoch to pre-render
+        echo: most uses of each batch (see loader.EchoingLoader), needs batch_aug
+        num_views: views per image (see dataset.AugmentedDataset)
+        dataset: name of dataset in dataset.dataset_names
     Returns: train_data_loader:torch dataloader object
     """
 
@@ -270,21 +555,23 @@ def get_training_dataloader(data_dir, all_tfs, batch_size=16, num_workers=2, shu
 
     #cifar100_training = CIFAR100Train(path, transform=transform_train)
     # cifar100_training = torchvision.datasets.CIFAR100(root='./data', train=True, download=True, transform=transform_train)
-    cifar100_training = AugmentedDataset(data_dir, transform_list=all_tfs, train=True)
-    
-    cifar100_training_loader = DataLoader(
-        cifar100_training, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    if backend == 'memory' and batch_aug is None:
+        batch_aug = BatchAugment(all_tfs, normalize=not uint8)
+    cifar100_training = AugmentedDataset(data_dir, dataset=dataset, transform_list=all_tfs, train=True, raw=batch_aug is not None, cache=cache,
+                                         store=store, seed=seed, tensor=uint8 and batch_aug is None, num_views=num_views)
+    cifar100_training_loader = get_loader(cifar100_training, all_tfs, batch_size, num_workers, shuffle, batch_aug,
+                                          aug_sampler, seed, uint8, device, backend, render_dir=render_dir,
+                                          pin_memory=pin_memory, persistent_workers=persistent_workers,
+                                          prefetch=prefetch, prefetch_factor=prefetch_factor, echo=echo,
+                                          last_epoch=last_epoch)
 
     return cifar100_training_loader
 
-def get_test_dataloader(data_dir, all_tfs, batch_size=16, num_workers=2, shuffle=True):
-    """ return testing dataloader
-    Args:
-        data_dir: path to data directory
-        all_tfs: list of transformation combinations
-        batch_size: dataloader batchsize
-        num_workers: dataloader num_works
-        shuffle: whether to shuffle
+def get_test_dataloader(data_dir, all_tfs, batch_size=16, num_workers=2, shuffle=True, batch_aug=None, cache=False,
+                        store=None, aug_sampler=None, seed=None, uint8=False, device=None, backend='workers',
+                        pin_memory=False, persistent_workers=False, prefetch=0, prefetch_factor=2, num_views=1,
+                        dataset='cifar100'):
+    """ return testing dataloader, the arguments are those of get_training_dataloader
     Returns: test_data_loader:torch dataloader object
     """
 
@@ -295,29 +582,207 @@ def get_test_dataloader(data_dir, all_tfs, batch_size=16, num_workers=2, shuffle
     # #cifar100_test = CIFAR100Test(path, transform=transform_test)
     # cifar100_test = torchvision.datasets.CIFAR100(root='./data', train=False, download=True, transform=transform_test)
 
-    cifar100_test = AugmentedDataset(data_dir, transform_list=all_tfs, train=False)
-    cifar100_test_loader = DataLoader(
-        cifar100_test, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    if backend == 'memory' and batch_aug is None:
+        batch_aug = BatchAugment(all_tfs, normalize=not uint8)
+    cifar100_test = AugmentedDataset(data_dir, dataset=dataset, transform_list=all_tfs, train=False, raw=batch_aug is not None, cache=cache,
+                                     store=store, seed=seed, tensor=uint8 and batch_aug is None, num_views=num_views)
+    cifar100_test_loader = get_loader(cifar100_test, all_tfs, batch_size, num_workers, shuffle, batch_aug,
+                                      aug_sampler, seed, uint8, device, backend, pin_memory=pin_memory,
+                                      persistent_workers=persistent_workers, prefetch=prefetch,
+                                      prefetch_factor=prefetch_factor)
 
     return cifar100_test_loader
 
-def compute_mean_std(cifar100_dataset):
-    """compute the mean and std of cifar100 dataset
+class NormalizedLoader(object):
+    """
+        Wraps a loader whose batches of images are still uint8 and does what
+        ToTensor and Normalize would do per sample once per batch, on the device
+        if one is given, so that workers only ship a byte per channel. Anything
+        else, e.g. dataset or batch_sampler, is looked up on the wrapped loader.
     Args:
-        cifar100_training_dataset or cifar100_test_dataset
-        witch derived from class torch.utils.data
-
-    Returns:
-        a tuple contains mean, std value of entire dataset
+        loader: loader yielding (images, true_labels, aug_labels) with uint8 images
+        mean: mean of training dataset
+        std: std of training dataset
+        device: device to move the batches to before normalizing them
+    """
+    def __init__(self, loader, mean, std, device=None):
+        self.loader = loader
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.device = device
+
+    def normalize(self, images):
+        images = images.float().div_(255)
+        return images.sub_(self.mean.to(images.device)).div_(self.std.to(images.device))
+
+    def __iter__(self):
+        for images, true_labels, aug_labels in self.loader:
+            if self.device is not None:
+                images = images.to(self.device, non_blocking=True)
+                true_labels = true_labels.to(self.device, non_blocking=True)
+                aug_labels = aug_labels.to(self.device, non_blocking=True)
+            yield self.normalize(images), true_labels, aug_labels
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+class FrozenTestLoader(object):
+    """
+        Augmented test set rendered once with a fixed seed and kept as a single
+        tensor, on the device if one is given, or in pinned memory otherwise.
+        Iterating yields (images, true_labels, aug_labels) slices of it, so every
+        epoch scores the same augmented images with a few large forwards and no
+        DataLoader. With torch.distributed initialized, each rank iterates every
+        world size-th slice.
+    Args:
+        test_loader: loader over the AugmentedDataset to render, its collate_fn
+            is reused so the images come out exactly as the loader yields them,
+            a NormalizedLoader keeps the set uint8 and normalizes every slice
+        batch_size: number of images per forward
+        device: device to keep the rendered set on
+        seed: seed of the aug labels and transformation parameters
+    """
+    def __init__(self, test_loader, batch_size=1000, device=None, seed=0):
+        # slices never split the views of an image
+        num_views = test_loader.dataset.num_views
+        self.batch_size = max(batch_size // num_views, 1) * num_views
+        self.normalize = test_loader.normalize if isinstance(test_loader, NormalizedLoader) else None
+
+        # render sequentially in this process so the seed alone fixes the result
+        render_loader = DataLoader(test_loader.dataset, batch_size=batch_size, shuffle=False,
+                                   num_workers=0, collate_fn=test_loader.collate_fn)
+        np_state, py_state = numpy.random.get_state(), random.getstate()
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            numpy.random.seed(seed)
+            random.seed(seed)
+            batches = list(render_loader)
+        numpy.random.set_state(np_state)
+        random.setstate(py_state)
+        # only its dataset is used from here on
+        if hasattr(test_loader, 'close'):
+            test_loader.close()
+
+        tensors = [torch.cat([torch.as_tensor(b[i]) for b in batches]) for i in range(3)]
+        if device is not None:
+            tensors = [t.to(device) for t in tensors]
+        elif torch.cuda.is_available():
+            tensors = [t.pin_memory() for t in tensors]
+        self.dataset = TensorDataset(*tensors)
+
+    def __iter__(self):
+        rank, world_size = get_rank(), get_world_size()
+        for start in range(rank * self.batch_size, len(self.dataset), world_size * self.batch_size):
+            images, true_labels, aug_labels = (t[start:start + self.batch_size] for t in self.dataset.tensors)
+            if self.normalize is not None:
+                images = self.normalize(images)
+            yield images, true_labels, aug_labels
+
+    def __len__(self):
+        num_batches = -(-len(self.dataset) // self.batch_size)
+        return len(range(get_rank(), num_batches, get_world_size()))
+
+def pool_views(outputs, num_views):
+    """ class probabilities of each image, averaged over its num_views
+    consecutive views in outputs (see dataset.AugmentedDataset)
     """
+    return outputs.softmax(1).view(-1, num_views, outputs.size(1)).mean(1)
 
-    data_r = numpy.dstack([cifar100_dataset[i][1][:, :, 0] for i in range(len(cifar100_dataset))])
-    data_g = numpy.dstack([cifar100_dataset[i][1][:, :, 1] for i in range(len(cifar100_dataset))])
-    data_b = numpy.dstack([cifar100_dataset[i][1][:, :, 2] for i in range(len(cifar100_dataset))])
-    mean = numpy.mean(data_r), numpy.mean(data_g), numpy.mean(data_b)
-    std = numpy.std(data_r), numpy.std(data_g), numpy.std(data_b)
+def chunk_stats(data):
+    """ (count, mean, M2) per channel of a chunk of NHWC uint8 images scaled to [0, 1],
+    M2 being the sum of squared deviations from the mean
+    """
+    pixels = numpy.asarray(data, dtype=numpy.float64).reshape(-1, data.shape[-1]) / 255
+    mean = pixels.mean(0)
+    return len(pixels), mean, ((pixels - mean) ** 2).sum(0)
+
+def merge_stats(a, b):
+    """ (count, mean, M2) of the union of two disjoint sets of pixels (Chan et al.) """
+    (n_a, mean_a, m2_a), (n_b, mean_b, m2_b) = a, b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n
+
+def _init_stats_worker(data):
+    _stats_state['data'] = data
+
+def _range_stats(start, end, chunk_size):
+    data = _stats_state['data']
+    stats = chunk_stats(data[start:min(start + chunk_size, end)])
+    for i in range(start + chunk_size, end, chunk_size):
+        stats = merge_stats(stats, chunk_stats(data[i:min(i + chunk_size, end)]))
+    return stats
+
+def compute_mean_std(data, num_workers=0, chunk_size=1024):
+    """ mean and std per channel of NHWC uint8 images, in one streaming pass of
+    chunk_size images at a time, split across a process pool whose partial
+    statistics are merged, so memory stays at a few chunks whatever the size
+    Args:
+        data: array of the images, e.g. the data of a dataset split (a memory
+            map or shared memory, which the workers read without a copy)
+        num_workers: number of processes, 0 to reduce in this process
+        chunk_size: number of images reduced at once
+    Returns: mean and std tuples of the images scaled to [0, 1]
+    """
+    num_ranges = max(num_workers, 1)
+    bounds = numpy.linspace(0, len(data), num_ranges + 1).astype(int)
+    ranges = [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
 
-    return mean, std
+    if num_workers:
+        with ProcessPoolExecutor(num_workers, initializer=_init_stats_worker, initargs=(data,)) as pool:
+            partials = list(pool.map(_range_stats, *zip(*ranges), [chunk_size] * len(ranges)))
+    else:
+        _init_stats_worker(data)
+        partials = [_range_stats(start, end, chunk_size) for start, end in ranges]
+        _stats_state.clear()
+
+    n, mean, m2 = functools.reduce(merge_stats, partials)
+    return tuple(mean.tolist()), tuple(numpy.sqrt(m2 / n).tolist())
+
+def stats_key(dataset):
+    """ key of the statistics of a dataset in the stats cache """
+    if dataset == 'synthetic':
+        return 'synthetic|{train_size}|{seed}'.format(**synthetic_config)
+    return dataset
+
+def get_mean_std(data_dir, dataset='cifar100', num_workers=None):
+    """ mean and std of the training split of dataset, from dataset_mean_std, or
+    from the stats cache (settings.STATS_CACHE), where they are computed once
+    with compute_mean_std for any other dataset
+    Args:
+        data_dir: path to data directory
+        dataset: name of dataset in dataset.dataset_names
+        num_workers: processes to compute them with, defaults to the cores
+    """
+    if dataset in dataset_mean_std:
+        return dataset_mean_std[dataset]
+
+    key = stats_key(dataset)
+    stats = load_json(settings.STATS_CACHE)
+    if key not in stats:
+        print('computing the mean and std of {}.....'.format(key))
+        data = dataset_names[dataset](data_dir, train=True).data
+        stats[key] = compute_mean_std(data, num_workers=os.cpu_count() if num_workers is None else num_workers)
+        update_json(settings.STATS_CACHE, key, stats[key])
+
+    mean, std = stats[key]
+    return tuple(mean), tuple(std)
+
+def get_memory_usage():
+    """ return resident and shared memory of this process in MB """
+    try:
+        with open('/proc/self/statm') as f:
+            resident, shared = [int(v) for v in f.read().split()[1:3]]
+        page_mb = os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+        return resident * page_mb, shared * page_mb
+    except (OSError, ValueError):
+        # no procfs, fall back to peak resident memory (KB on linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10, 0.0
 
 class WarmUpLR(_LRScheduler):
     """warmup_training learning rate scheduler
@@ -337,6 +802,73 @@ class WarmUpLR(_LRScheduler):
         return [base_lr * self.last_epoch / (self.total_iters + 1e-8) for base_lr in self.base_lrs]
 
 
+class MetricAccumulator(object):
+    """
+        Keeps metrics on the device until they are needed on the host, where
+        calling .item() on each of them every step would sync the device every
+        step. Per-step scalars are logged to the writer, and running sums read,
+        all at once in a single transfer, the same values .item() would have
+        given. syncs counts the transfers.
+    Args:
+        writer: SummaryWriter the per-step scalars are logged to
+        flush_every: steps between flushes of the per-step scalars, 0 to only
+            flush when flush() is called
+        device: device of the running sums
+        sum_tags: running sums starting at 0, so that every rank reduces the
+            same sums, also a rank that did not add to them
+    """
+    def __init__(self, writer=None, flush_every=0, device=None, sum_tags=()):
+        self.writer = writer
+        self.flush_every = flush_every
+        self.device = device
+        # (tag, step, value) of the scalars not logged yet
+        self.pending = []
+        self.sum_tags = sum_tags
+        self.sums = {tag: torch.zeros((), dtype=torch.float64, device=device) for tag in sum_tags}
+        self.steps = 0
+        self.syncs = 0
+
+    def add(self, tag, value, step):
+        """ log the scalar tensor value under tag for step, at the next flush """
+        self.pending.append((tag, step, value.detach()))
+
+    def sum(self, tag, value):
+        """ add the scalar value to the running sum tag, kept in float64 """
+        if tag not in self.sums:
+            self.sums[tag] = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.sums[tag] += value
+
+    def step(self):
+        """ end a step, flushing every flush_every steps """
+        self.steps += 1
+        if self.flush_every and self.steps % self.flush_every == 0:
+            self.flush()
+
+    def to_host(self, tensors):
+        """ tensors as float64 cpu tensors of the same shapes, in one transfer """
+        if not tensors:
+            return []
+        flat = torch.cat([t.detach().reshape(-1).double() for t in tensors]).cpu()
+        self.syncs += 1
+        return [v.view(t.shape) for v, t in zip(flat.split([t.numel() for t in tensors]), tensors)]
+
+    def flush(self):
+        """ log the pending per-step scalars """
+        values = self.to_host([value for _, _, value in self.pending])
+        for (tag, step, _), value in zip(self.pending, values):
+            self.writer.add_scalar(tag, value.item(), step)
+        self.pending = []
+
+    def reduce_sums(self):
+        """ the running sums summed across the ranks, as a dict of floats, and reset them """
+        tags = list(self.sums)
+        if not tags:
+            return {}
+        sums = all_reduce_sum(torch.stack([self.sums[tag] for tag in tags]))
+        self.sums = {tag: torch.zeros((), dtype=torch.float64, device=self.device) for tag in self.sum_tags}
+        return dict(zip(tags, self.to_host([sums])[0].tolist()))
+
+
 def most_recent_folder(net_weights, fmt):
     """
         return most recent created folder under net_weights
@@ -359,12 +891,13 @@ def most_recent_weights(weights_folder):
         return most recent created weights file
         if folder is empty return empty string
     """
-    weight_files = os.listdir(weights_folder)
-    if len(weights_folder) == 0:
-        return ''
-
     regex_str = r'([A-Za-z0-9]+)-([0-9]+)-(regular|best)'
 
+    # skip anything that is not a weights file, e.g. the mid-epoch resume state
+    weight_files = [w for w in os.listdir(weights_folder) if re.search(regex_str, w)]
+    if len(weight_files) == 0:
+        return ''
+
     # sort files by epoch
     weight_files = sorted(weight_files, key=lambda w: int(re.search(regex_str, w).groups()[1]))
 
@@ -388,7 +921,7 @@ def best_acc_weights(weights_folder):
         return ''
 
     regex_str = r'([A-Za-z0-9]+)-([0-9]+)-(regular|best)'
-    best_files = [w for w in files if re.search(regex_str, w).groups()[2] == 'best']
+    best_files = [w for w in files if re.search(regex_str, w) and re.search(regex_str, w).groups()[2] == 'best']
     if len(best_files) == 0:
         return ''
 
@@ -397,9 +930,10 @@ def best_acc_weights(weights_folder):
 
 ##################
 def knn_monitor(net, memory_data_loader, test_data_loader, device='cuda', k=200, t=0.1, hide_progress=False,
-                targets=None, epoch=0, writer=None):
+                targets=None, epoch=0, writer=None, amp='off'):
     """
-        kNN monitor
+        kNN monitor, extracting the features under the autocast of amp and
+        searching the neighbours in fp32
     """
     start = time.time()
     if not targets:
@@ -411,8 +945,9 @@ def knn_monitor(net, memory_data_loader, test_data_loader, device='cuda', k=200,
     with torch.no_grad():
         # generate feature bank
         for data, target, _ in memory_data_loader:
-            feature = net(data.to(device=device, non_blocking=True), extract_features=True)
-            feature_bank.append(feature)
+            with autocast(device, amp):
+                feature = net(data.to(device=device, non_blocking=True), extract_features=True)
+            feature_bank.append(feature.float())
         # [D, N]
         feature_bank = torch.cat(feature_bank, dim=0).contiguous()
         # [N]
@@ -420,12 +955,16 @@ def knn_monitor(net, memory_data_loader, test_data_loader, device='cuda', k=200,
         # loop test data to predict the label by weighted knn search
         for data, target, _ in test_data_loader:
             data, target = data.to(device=device, non_blocking=True), target.to(device=device, non_blocking=True)
-            feature = net(data, extract_features=True)
+            with autocast(device, amp):
+                feature = net(data, extract_features=True).float()
 
             pred_labels = knn_predict(feature, feature_bank, feature_labels, classes, k, t)
 
             total_num += data.size(0)
-            total_top1 += (pred_labels[:, 0].cuda() == target).float().sum().item()
+            total_top1 += (pred_labels[:, 0].to(target.device) == target).float().sum().item()
+
+    # every rank holds the whole memory bank and scores its shard of the test set
+    total_top1, total_num = all_reduce_sum(torch.tensor([total_top1, total_num], dtype=torch.float64, device=device)).tolist()
 
     finish = time.time()
     print('Evaluating Network.....')